@@ -0,0 +1,76 @@
+from io import BytesIO
+from typing import List, Tuple, Union
+
+from PIL import Image
+
+from file_metadata import ArtHandle
+from img_diff import image_difference
+
+
+# Crops and re-encodes of the same cover stay under this, different covers
+# are usually well above 20
+SAME_COVER_MAX_DIFFERENCE = 16
+
+
+def auto_select_art(
+    choices: List[Union[bytes, ArtHandle]], sources: List[str]
+) -> Tuple[int, bool]:
+    """
+    Pick cover art without asking anyone. sources says where each choice came
+    from, like "embedded" or "spotify". Candidates that look alike are
+    grouped, and the group found by the most different sources wins, since
+    independent sources agreeing is the best sign of the right cover. Within
+    that group the copy with the highest resolution wins, then the squarest
+    one, then the one compressed the least. Returns the index of the pick and
+    whether it can be trusted: the winning group must come from at least two
+    sources, and from more sources than every other group.
+    """
+    images_bytes = []
+    for choice in choices:
+        if isinstance(choice, ArtHandle):
+            choice = choice.read()
+        images_bytes.append(choice)
+
+    groups = []
+    for i, image_bytes in enumerate(images_bytes):
+        is_grouped = False
+        for group in groups:
+            if is_grouped:
+                break
+            difference = image_difference(images_bytes[group[0]], image_bytes)
+            if difference <= SAME_COVER_MAX_DIFFERENCE:
+                group.append(i)
+                is_grouped = True
+        if not is_grouped:
+            groups.append([i])
+
+    source_counts = []
+    for group in groups:
+        group_sources = set()
+        for i in group:
+            group_sources.add(sources[i])
+        source_counts.append(len(group_sources))
+
+    best_group = 0
+    for i in range(len(groups)):
+        if source_counts[i] > source_counts[best_group]:
+            best_group = i
+    is_confident = source_counts[best_group] >= 2
+    for i in range(len(groups)):
+        if i != best_group and source_counts[i] == source_counts[best_group]:
+            is_confident = False
+
+    best_index = groups[best_group][0]
+    best_rank = None
+    for i in groups[best_group]:
+        width, height = Image.open(BytesIO(images_bytes[i])).size
+        rank = (
+            min(width, height),
+            min(width, height) / max(width, height),
+            len(images_bytes[i]) / (width * height),
+        )
+        if best_rank is None or rank > best_rank:
+            best_index = i
+            best_rank = rank
+
+    return best_index, is_confident
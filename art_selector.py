@@ -1,25 +1,56 @@
 from io import BytesIO
 import math
 from tkinter import Button, Event, Label, Tk
-from typing import List
+from typing import List, Union
 
 from PIL import Image, ImageDraw, ImageTk
 
+from file_metadata import ArtHandle
+
 
 THUMBNAIL_SIZE = 200
 ZOOM_BOX_HEIGHT = 600
 
 
 class CoverArtSelector:
-    def __init__(self, images_bytes: List[bytes]) -> None:
+    def __init__(self, images_bytes: List[Union[bytes, ArtHandle]]) -> None:
         # Convert bytes to PIL Images
         self.images_pil = []
         for image_bytes in images_bytes:
+            if isinstance(image_bytes, ArtHandle):
+                image_bytes = image_bytes.read()
             image = Image.open(BytesIO(image_bytes))
             self.images_pil.append(image)
 
         self.image_index = -1
 
+        # Do all the resizing up front, so a selector can be prepared in the
+        # background while another window is still open
+        num_thumbnails = len(self.images_pil)
+        self.zoom_box_width = (
+            num_thumbnails * THUMBNAIL_SIZE + (num_thumbnails - 1) * 10
+        )
+        self.thumbnails = []
+        for image in self.images_pil:
+            self.thumbnails.append(self.generate_thumbnail(image))
+
+        # If any of the original images are smaller than the width of the zoomed area, scale them up
+        self.images_pil_resized = []
+        for i in range(num_thumbnails):
+            width = self.images_pil[i].width
+            if width < self.zoom_box_width:
+                size_multiplier = math.floor(self.zoom_box_width / width) + 1
+            else:
+                # Double zoom of even high-res images just so we can get a better look at the details
+                size_multiplier = 2
+
+            self.images_pil_resized.append(
+                self.images_pil[i].resize(
+                    (width * size_multiplier, width * size_multiplier),
+                    resample=Image.Resampling.NEAREST,
+                )
+            )
+
     def motion(self, event: Event) -> None:
         # Buttons have 5px padding, subtract to get exact coords relative to image
         x, y = event.x - 5, event.y - 5
@@ -110,9 +141,6 @@ class CoverArtSelector:
         self.root = Tk()
         self.root.title("covert artwork selector")
 
-        self.zoom_box_width = (
-            num_thumbnails * THUMBNAIL_SIZE + (num_thumbnails - 1) * 10
-        )
         image_pil = Image.new(mode="RGB", size=(self.zoom_box_width, ZOOM_BOX_HEIGHT))
         zoom_box_image_tk = ImageTk.PhotoImage(image_pil)
 
@@ -126,8 +154,7 @@ class CoverArtSelector:
         # Create thumbnail buttons
         self.images_tk = []
         for i in range(len(self.images_pil)):
-            image_pil = self.generate_thumbnail(self.images_pil[i])
-            self.images_tk.append(ImageTk.PhotoImage(image_pil))
+            self.images_tk.append(ImageTk.PhotoImage(self.thumbnails[i]))
             Button(
                 self.root,
                 name=str(i),
@@ -135,23 +162,6 @@ class CoverArtSelector:
                 command=self.root.destroy,
             ).grid(column=i, row=1)
 
-        # If any of the original images are smaller than the width of the zoomed area, scale them up
-        self.images_pil_resized = []
-        for i in range(num_thumbnails):
-            width = self.images_pil[i].width
-            if width < self.zoom_box_width:
-                size_multiplier = math.floor(self.zoom_box_width / width) + 1
-            else:
-                # Double zoom of even high-res images just so we can get a better look at the details
-                size_multiplier = 2
-
-            self.images_pil_resized.append(
-                self.images_pil[i].resize(
-                    (width * size_multiplier, width * size_multiplier),
-                    resample=Image.Resampling.NEAREST,
-                )
-            )
-
         self.root.bind("<Motion>", self.motion)
         self.root.mainloop()
         return self.image_index
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from file_metadata import (
+    TAG_FIELDS,
+    TAG_PADDING,
+    NoTagError,
+    TagTransaction,
+    clear_album_artist,
+    clear_album_title,
+    clear_artist,
+    clear_cover_art,
+    clear_lyrics,
+    clear_song_title,
+    clear_year,
+    get_album_artist,
+    get_album_title,
+    get_artist,
+    get_cover_art,
+    get_lyrics,
+    get_song_title,
+    get_year,
+    set_album_artist,
+    set_album_title,
+    set_artist,
+    set_cover_art,
+    set_lyrics,
+    set_song_title,
+    set_year,
+)
+
+
+EDITS_PER_FILE = 20
+
+# (name, getter, setter, clearer, value given to the setter)
+OPERATIONS = [
+    ("year", get_year, set_year, clear_year, 2024),
+    ("album_title", get_album_title, set_album_title, clear_album_title, "Bench"),
+    ("artist", get_artist, set_artist, clear_artist, "Bench Artist"),
+    (
+        "album_artist",
+        get_album_artist,
+        set_album_artist,
+        clear_album_artist,
+        "Bench Album Artist",
+    ),
+    ("song_title", get_song_title, set_song_title, clear_song_title, "Bench Song"),
+    ("lyrics", get_lyrics, set_lyrics, clear_lyrics, "la la la\n" * 40),
+    ("cover_art", get_cover_art, set_cover_art, clear_cover_art, None),
+]
+
+
+def bytes_written_so_far() -> int:
+    # Linux only: every byte this process has passed to write()
+    with open("/proc/self/io") as f:
+        for line in f:
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    raise RuntimeError("/proc/self/io has no wchar line")
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def generate_corpus(directory: str, count: int, fields, art_size: int, padding: int):
+    """
+    Make count copies of the test fixtures, alternating MP3 and FLAC, each with
+    the given tag fields filled in and art_size bytes of cover art.
+    """
+    art = os.urandom(art_size)
+    files = []
+    for i in range(count):
+        if i % 2 == 0:
+            extension = "mp3"
+        else:
+            extension = "flac"
+        filename = os.path.join(directory, f"{i:06d}.{extension}")
+        shutil.copyfile(f"test/yeet.{extension}", filename)
+
+        with TagTransaction(filename, padding=padding) as transaction:
+            for field in TAG_FIELDS:
+                transaction.clear(field)
+            for field in fields:
+                if field == "cover_art":
+                    transaction.set(field, art)
+                elif field == "year":
+                    transaction.set(field, 2000 + i % 25)
+                else:
+                    transaction.set(field, f"{field} {i}")
+        files.append(filename)
+    return files
+
+
+def time_operation(function, files, *args):
+    missing = 0
+    bytes_before = bytes_written_so_far()
+    start = time.perf_counter()
+    for filename in files:
+        try:
+            function(filename, *args)
+        except NoTagError:
+            missing += 1
+    seconds = time.perf_counter() - start
+    bytes_written = bytes_written_so_far() - bytes_before
+
+    return {
+        "files_per_second": len(files) / seconds,
+        "bytes_written_per_operation": bytes_written / len(files),
+        "peak_rss_kb": peak_rss_kb(),
+        "missing": missing,
+    }
+
+
+def run_suite(count: int, fields, art_size: int, padding: int):
+    temp_dir = tempfile.mkdtemp()
+    files = generate_corpus(temp_dir, count, fields, art_size, padding)
+
+    results = {}
+    for name, getter, setter, clearer, value in OPERATIONS:
+        if value is None:
+            value = os.urandom(art_size)
+        results[f"get_{name}"] = time_operation(getter, files)
+        results[f"set_{name}"] = time_operation(setter, files, value)
+        results[f"clear_{name}"] = time_operation(clearer, files)
+
+    shutil.rmtree(temp_dir)
+    return results
+
+
+def benchmark_padding(corpus_files, padding: int):
+    """
+    Grow the lyrics of every file a little at a time, the way repeated
+    re-tagging does, and count how often the whole file had to be rewritten.
+    """
+    temp_dir = tempfile.mkdtemp()
+    copies = []
+    for filename in corpus_files:
+        copy = os.path.join(temp_dir, os.path.basename(filename))
+        shutil.copy2(filename, copy)
+        copies.append(copy)
+
+    rewrites = 0
+    start = time.perf_counter()
+    for edit in range(EDITS_PER_FILE):
+        lyrics = "la " * 300 * (edit + 1)
+        for copy in copies:
+            with TagTransaction(copy, padding=padding) as transaction:
+                transaction.set("lyrics", lyrics)
+            if transaction.rewrote_file:
+                rewrites += 1
+    seconds = time.perf_counter() - start
+
+    shutil.rmtree(temp_dir)
+    return rewrites, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the file_metadata getters, setters and clears on a synthetic corpus."
+    )
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[1000, 10000], help="Corpus sizes"
+    )
+    parser.add_argument(
+        "--fields",
+        nargs="+",
+        default=TAG_FIELDS,
+        choices=TAG_FIELDS,
+        help="Tag fields filled in on every generated file",
+    )
+    parser.add_argument("--art-size", type=int, default=100 * 1024)
+    parser.add_argument("--padding", type=int, default=TAG_PADDING)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument(
+        "--padding-corpus",
+        help="Instead of the suite, compare re-tagging with and without padding on the files in this folder",
+    )
+    args = parser.parse_args()
+
+    if args.padding_corpus is not None:
+        corpus_files = []
+        for filename in sorted(os.listdir(args.padding_corpus)):
+            if filename.lower().endswith((".mp3", ".flac")):
+                corpus_files.append(os.path.join(args.padding_corpus, filename))
+
+        total_edits = EDITS_PER_FILE * len(corpus_files)
+        for padding in [0, TAG_PADDING]:
+            rewrites, seconds = benchmark_padding(corpus_files, padding)
+            print(
+                f"padding {padding:>6} bytes: {rewrites}/{total_edits} saves rewrote "
+                f"the whole file, {seconds:.2f}s"
+            )
+        sys.exit(0)
+
+    report = {
+        "fields": args.fields,
+        "art_size": args.art_size,
+        "padding": args.padding,
+        "results": {},
+    }
+    for count in args.counts:
+        report["results"][str(count)] = run_suite(
+            count, args.fields, args.art_size, args.padding
+        )
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,100 @@
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from io import BytesIO
+import json
+import os
+import sys
+from typing import Any, Dict, TextIO
+
+from mutagen import File
+from PIL import Image
+
+from file_metadata import Tags, tags_from_file
+from library_index import iter_audio_files
+
+
+def export_track(filename: str) -> Dict[str, Any]:
+    """
+    One line of the export: the tags, audio properties and cover art summary
+    of a file, or the error that stopped it from being read.
+    """
+    try:
+        # One parse gives both the tags and the audio properties
+        audiofile = File(filename)
+        tags = Tags()
+        if audiofile is not None:
+            tags = tags_from_file(audiofile)
+
+        record = {
+            "path": filename,
+            "title": tags.title,
+            "artist": tags.artist,
+            "album": tags.album,
+            "album_artist": tags.album_artist,
+            "year": tags.year,
+            "lyrics": tags.lyrics,
+            "duration": None,
+            "bitrate": None,
+            "art_digest": None,
+            "art_width": None,
+            "art_height": None,
+        }
+
+        if audiofile is not None:
+            record["duration"] = audiofile.info.length
+            record["bitrate"] = getattr(audiofile.info, "bitrate", None)
+
+        if tags.cover_art is not None:
+            record["art_digest"] = hashlib.sha256(tags.cover_art).hexdigest()
+            # Image.open only decodes the header, which is enough for the size
+            image = Image.open(BytesIO(tags.cover_art))
+            record["art_width"], record["art_height"] = image.size
+
+        return record
+    except Exception as e:
+        # One unreadable file shouldn't stop the export of the rest
+        return {"path": filename, "error": f"{type(e).__name__}: {e}"}
+
+
+def export_library(root: str, output: TextIO, workers: int = 4) -> int:
+    """
+    Write one JSON line per audio file under root to output, in walk order.
+    Files are read on a process pool, with only a few of them in flight per
+    worker at a time, so memory stays flat however big the library is.
+    Returns how many lines were written.
+    """
+    in_flight = deque()
+    lines_written = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for entry in iter_audio_files(root):
+            in_flight.append(executor.submit(export_track, entry.path))
+
+            if len(in_flight) >= workers * 4:
+                output.write(json.dumps(in_flight.popleft().result()) + "\n")
+                lines_written += 1
+
+        while in_flight:
+            output.write(json.dumps(in_flight.popleft().result()) + "\n")
+            lines_written += 1
+
+    return lines_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the tags of every audio file in a library as JSON lines."
+    )
+    parser.add_argument("library", help="Folder to walk")
+    parser.add_argument("--output", help="Write the JSON lines here instead of stdout")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.output is None:
+        lines_written = export_library(args.library, sys.stdout, args.workers)
+    else:
+        with open(args.output, "w") as f:
+            lines_written = export_library(args.library, f, args.workers)
+    print(f"Exported {lines_written} files.", file=sys.stderr)
@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import shutil
+import sys
+from typing import Dict, List, Optional, Tuple
+
+if sys.platform == "linux":
+    import fcntl
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# ioctl number from linux/fs.h
+FICLONE = 0x40049409
+
+
+class CopyVerificationError(Exception):
+    pass
+
+
+def file_sha256(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        chunk = f.read(COPY_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(COPY_CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def copy_file(
+    source: str,
+    destination: str,
+    verify: bool = True,
+    source_digest: Optional[str] = None,
+) -> str:
+    """
+    Copy source to destination, with its permissions and times like shutil.copy2.
+    The cheapest copy the filesystem allows is used: a reflink, which shares
+    the data blocks on btrfs and XFS so it takes no time or space, then
+    os.copy_file_range, which copies inside the kernel, then a buffered copy.
+    With verify set, the copy is hashed and CopyVerificationError is raised if
+    it doesn't match the source. Unless the caller passes the source's SHA-256
+    as source_digest, the source is hashed as it is copied, so a buffered copy
+    is used instead of os.copy_file_range. Reflinks aren't checked, since both
+    files share the same blocks. CopyVerificationError is also raised if the
+    source ends early, as when it shrinks during the copy.
+    Returns "reflink", "copy_file_range" or "buffered".
+    """
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        method = None
+
+        if sys.platform == "linux":
+            try:
+                fcntl.ioctl(destination_fd, FICLONE, source_fd)
+                method = "reflink"
+            except OSError:
+                # Filesystem without reflinks, or the files are on different filesystems
+                pass
+
+        can_skip_hashing = not verify or source_digest is not None
+        if method is None and can_skip_hashing and hasattr(os, "copy_file_range"):
+            size = os.fstat(source_fd).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    count = os.copy_file_range(source_fd, destination_fd, size - copied)
+                    if count == 0:
+                        raise CopyVerificationError(
+                            f"Copy of {source} stopped after {copied} of {size} bytes"
+                        )
+                    copied += count
+                method = "copy_file_range"
+            except OSError:
+                # Older kernels refuse to copy between filesystems
+                source_file.seek(0)
+                destination_file.seek(0)
+                destination_file.truncate()
+
+        if method is None:
+            digest = hashlib.sha256()
+            chunk = source_file.read(COPY_CHUNK_SIZE)
+            while chunk:
+                digest.update(chunk)
+                destination_file.write(chunk)
+                chunk = source_file.read(COPY_CHUNK_SIZE)
+            if source_digest is None:
+                source_digest = digest.hexdigest()
+            method = "buffered"
+
+    shutil.copystat(source, destination)
+
+    if verify and method != "reflink":
+        if file_sha256(destination) != source_digest:
+            os.remove(destination)
+            raise CopyVerificationError(f"Copy of {source} doesn't match the original")
+    return method
+
+
+def copy_files(
+    copies: List[Tuple[str, str]],
+    workers: int = 4,
+    verify: bool = True,
+    source_digests: Optional[Dict[str, str]] = None,
+) -> Dict[str, int]:
+    """
+    Run copy_file on many (source, destination) pairs on a thread pool.
+    source_digests maps source paths to SHA-256s the caller already has.
+    Returns how many files were copied with each method.
+    """
+
+    def copy_pair(pair: Tuple[str, str]) -> str:
+        source_digest = None
+        if source_digests is not None:
+            source_digest = source_digests.get(pair[0])
+        return copy_file(pair[0], pair[1], verify, source_digest)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        methods = list(executor.map(copy_pair, copies))
+
+    counts = {}
+    for method in ["reflink", "copy_file_range", "buffered"]:
+        counts[method] = methods.count(method)
+    return counts
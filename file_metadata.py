@@ -1,12 +1,512 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+import hashlib
+from io import BytesIO
+import mmap
+import os
+import shutil
+import threading
+from typing import Any, BinaryIO, Dict, List, Optional, Union
+
 from mutagen import File
-from mutagen.id3 import APIC, TALB, TDRC, TIT2, TPE1, TPE2, USLT
+from mutagen.flac import Picture
+from mutagen.id3 import APIC, USLT, Frames
 from mutagen.mp3 import MP3
+from PIL import Image, ImageOps, UnidentifiedImageError
 
 
 class NoTagError(Exception):
     pass
 
 
+TAG_FIELDS = ["title", "artist", "album", "album_artist", "year", "lyrics", "cover_art"]
+
+MP3_TEXT_FRAMES = {
+    "title": "TIT2",
+    "artist": "TPE1",
+    "album": "TALB",
+    "album_artist": "TPE2",
+}
+
+VORBIS_TEXT_KEYS = {
+    "title": "TITLE",
+    "artist": "ARTIST",
+    "album": "ALBUM",
+    "album_artist": "ALBUMARTIST",
+    "lyrics": "LYRICS",
+}
+
+
+@dataclass
+class Tags:
+    title: Optional[str] = None
+    artist: Optional[str] = None
+    album: Optional[str] = None
+    album_artist: Optional[str] = None
+    year: Optional[int] = None
+    lyrics: Optional[str] = None
+    cover_art: Optional[bytes] = None
+
+
+@dataclass
+class ArtHandle:
+    """
+    Where a file's embedded cover art lives, so callers can check its size or
+    type without loading it. offset is None when the tag couldn't be parsed in
+    place, in which case read() goes through mutagen.
+    """
+
+    filename: str
+    offset: Optional[int]
+    length: int
+    mime: str
+
+    def read(self) -> bytes:
+        if self.offset is None:
+            return get_cover_art(self.filename)
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+
+def read_tags(filename: str, fields: List[str] = TAG_FIELDS) -> Tags:
+    """
+    Parse the file once and return every requested field.
+    Fields that aren't in the file are left as None.
+    """
+    for field in fields:
+        if field not in TAG_FIELDS:
+            raise ValueError(f"Unknown tag field '{field}'")
+
+    audiofile = File(filename)
+    if audiofile is None:
+        raise NoTagError("No tag found")
+    return tags_from_file(audiofile, fields)
+
+
+def tags_from_file(audiofile, fields: List[str] = TAG_FIELDS) -> Tags:
+    """
+    The requested fields of a file mutagen has already parsed, for callers that
+    also need its audio properties.
+    """
+    tags = Tags()
+
+    if isinstance(audiofile, MP3):
+        for field, frame in MP3_TEXT_FRAMES.items():
+            if field in fields and frame in audiofile:
+                setattr(tags, field, audiofile[frame].text[0])
+        if "year" in fields and "TDRC" in audiofile:
+            timestamp = audiofile["TDRC"].text[0]
+            tags.year = int(str(timestamp).split("-")[0])
+        uslt_frames = [key for key in audiofile.keys() if key.startswith("USLT")]
+        if "lyrics" in fields and uslt_frames:
+            tags.lyrics = audiofile[uslt_frames[0]].text
+        apic_frames = [key for key in audiofile.keys() if key.startswith("APIC")]
+        if "cover_art" in fields and apic_frames:
+            tags.cover_art = audiofile[apic_frames[0]].data
+    else:
+        for field, key in VORBIS_TEXT_KEYS.items():
+            if field in fields and audiofile.get(key):
+                setattr(tags, field, audiofile[key][0])
+        if "year" in fields and audiofile.get("DATE"):
+            # Usually just the year, but full dates like 2020-01-02 are common
+            tags.year = int(audiofile["DATE"][0].split("-")[0])
+        if "cover_art" in fields and getattr(audiofile, "pictures", None):
+            tags.cover_art = audiofile.pictures[0].data
+
+    return tags
+
+
+class _UnsupportedTag(Exception):
+    pass
+
+
+ID3_TEXT_ENCODINGS = ["latin-1", "utf-16", "utf-16-be", "utf-8"]
+
+
+def _read_terminated(data, start: int, end: int, encoding: int):
+    """
+    Read one null-terminated string between start and end.
+    Returns the text and the position just after the terminator.
+    """
+    if encoding == 1 or encoding == 2:
+        # UTF-16 terminators are two zero bytes on an even offset
+        text_end = start
+        while text_end + 1 < end and data[text_end : text_end + 2] != b"\x00\x00":
+            text_end += 2
+        terminator_length = 2
+    else:
+        text_end = data.find(b"\x00", start, end)
+        if text_end == -1:
+            text_end = end
+        terminator_length = 1
+
+    text = data[start:text_end].decode(ID3_TEXT_ENCODINGS[encoding])
+    return text, min(text_end + terminator_length, end)
+
+
+def _parse_id3(data, filename: str, fields: List[str]) -> Tags:
+    major_version = data[3]
+    flags = data[5]
+    if major_version not in (3, 4):
+        raise _UnsupportedTag("Only ID3v2.3 and ID3v2.4 are supported")
+    # Unsynchronisation and extended headers are rare, leave them to mutagen
+    if flags & 0xC0:
+        raise _UnsupportedTag("Unsupported ID3 header flags")
+
+    tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    tag_end = 10 + tag_size
+    field_frames = {}
+    for field, frame in MP3_TEXT_FRAMES.items():
+        field_frames[frame] = field
+    field_frames["TDRC"] = "year"
+    field_frames["TYER"] = "year"
+    field_frames["USLT"] = "lyrics"
+    field_frames["APIC"] = "cover_art"
+
+    tags = Tags()
+    position = 10
+    while position + 10 <= tag_end:
+        frame_id = data[position : position + 4].decode("latin-1")
+        if frame_id[0] == "\x00":
+            # Reached the padding
+            break
+
+        size_bytes = data[position + 4 : position + 8]
+        if major_version == 4:
+            frame_size = (
+                (size_bytes[0] << 21)
+                | (size_bytes[1] << 14)
+                | (size_bytes[2] << 7)
+                | size_bytes[3]
+            )
+        else:
+            frame_size = int.from_bytes(size_bytes, "big")
+        frame_flags = data[position + 9]
+        body_start = position + 10
+        position += 10 + frame_size
+
+        field = field_frames.get(frame_id)
+        if field is None or field not in fields or getattr(tags, field) is not None:
+            continue
+        # Compressed, encrypted or unsynchronised frames
+        if (major_version == 4 and frame_flags & 0x0F) or (
+            major_version == 3 and frame_flags & 0xE0
+        ):
+            raise _UnsupportedTag(f"Unsupported flags on {frame_id} frame")
+
+        encoding = data[body_start]
+        if field == "cover_art":
+            mime, description_start = _read_terminated(
+                data, body_start + 1, position, 0
+            )
+            # Skip the picture type byte
+            description, art_offset = _read_terminated(
+                data, description_start + 1, position, encoding
+            )
+            art_length = position - art_offset
+            tags.cover_art = ArtHandle(filename, art_offset, art_length, mime)
+        elif field == "lyrics":
+            # Skip the encoding byte and the three letter language code
+            description, text_start = _read_terminated(
+                data, body_start + 4, position, encoding
+            )
+            tags.lyrics, _ = _read_terminated(data, text_start, position, encoding)
+        else:
+            text, _ = _read_terminated(data, body_start + 1, position, encoding)
+            if field == "year":
+                tags.year = int(text.split("-")[0])
+            else:
+                setattr(tags, field, text)
+
+    return tags
+
+
+def _parse_flac(data, filename: str, fields: List[str]) -> Tags:
+    tags = Tags()
+    position = 4
+    is_last_block = False
+    while not is_last_block:
+        is_last_block = data[position] & 0x80
+        block_type = data[position] & 0x7F
+        block_length = int.from_bytes(data[position + 1 : position + 4], "big")
+        block_start = position + 4
+        position += 4 + block_length
+
+        if block_type == 4:
+            block = data[block_start:position]
+            # Vorbis comment, little endian unlike the rest of FLAC
+            vendor_length = int.from_bytes(block[0:4], "little")
+            offset = 4 + vendor_length
+            comment_count = int.from_bytes(block[offset : offset + 4], "little")
+            offset += 4
+            comments = {}
+            for _ in range(comment_count):
+                comment_length = int.from_bytes(block[offset : offset + 4], "little")
+                comment = block[offset + 4 : offset + 4 + comment_length]
+                offset += 4 + comment_length
+                key, _, value = comment.decode("utf-8").partition("=")
+                if key.upper() not in comments:
+                    comments[key.upper()] = value
+
+            for field, key in VORBIS_TEXT_KEYS.items():
+                # An empty value is kept as "", like mutagen does
+                if field in fields and key in comments:
+                    setattr(tags, field, comments[key])
+            if "year" in fields and comments.get("DATE"):
+                tags.year = int(comments["DATE"].split("-")[0])
+        elif block_type == 6 and "cover_art" in fields and tags.cover_art is None:
+            mime_length = int.from_bytes(data[block_start + 4 : block_start + 8], "big")
+            offset = block_start + 8 + mime_length
+            mime = data[block_start + 8 : offset].decode("ascii")
+            description_length = int.from_bytes(data[offset : offset + 4], "big")
+            # Skip the description, width, height, color depth and color count
+            offset += 4 + description_length + 16
+            art_length = int.from_bytes(data[offset : offset + 4], "big")
+            tags.cover_art = ArtHandle(filename, offset + 4, art_length, mime)
+
+    return tags
+
+
+# Remote storage mode: instead of memory mapping the file, which costs a network
+# round trip for every page mutagen or our parser touches, read the whole tag
+# region up front, usually in a single read of HEAD_READ_SIZE bytes
+REMOTE_STORAGE = False
+HEAD_READ_SIZE = 256 * 1024
+
+
+def _read_head(f) -> bytes:
+    """Read the ID3v2 tag or the FLAC metadata blocks at the start of the file."""
+    head = f.read(HEAD_READ_SIZE)
+    if head[0:3] == b"ID3":
+        tag_end = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+        if tag_end > len(head):
+            head += f.read(tag_end - len(head))
+    elif head[0:4] == b"fLaC":
+        position = 4
+        is_last_block = False
+        while not is_last_block:
+            if position + 4 > len(head):
+                more = f.read(position + HEAD_READ_SIZE - len(head))
+                if not more:
+                    break
+                head += more
+                continue
+            is_last_block = head[position] & 0x80
+            block_length = int.from_bytes(head[position + 1 : position + 4], "big")
+            position += 4 + block_length
+        if position > len(head):
+            head += f.read(position - len(head))
+    return head
+
+
+def _parse_head(data, filename: str, fields: List[str], load_art: bool):
+    try:
+        if data[0:4] == b"fLaC":
+            tags = _parse_flac(data, filename, fields)
+        elif data[0:3] == b"ID3" and filename.lower().endswith(".mp3"):
+            tags = _parse_id3(data, filename, fields)
+        else:
+            return None
+    except (_UnsupportedTag, IndexError, UnicodeDecodeError):
+        return None
+
+    if load_art and tags.cover_art is not None:
+        art_end = tags.cover_art.offset + tags.cover_art.length
+        tags.cover_art = data[tags.cover_art.offset : art_end]
+    return tags
+
+
+def _parse_tags_in_place(
+    filename: str, fields: List[str], load_art: bool
+) -> Optional[Tags]:
+    """
+    Decode the ID3v2 frames or FLAC metadata blocks without going through
+    mutagen. Normally the file is memory mapped so only the pages holding the
+    tag get read from disk. Cover art is returned as an ArtHandle unless
+    load_art is set. Returns None for anything mutagen should handle.
+    """
+    with open(filename, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < 10:
+            return None
+
+        if REMOTE_STORAGE:
+            tags = _parse_head(_read_head(f), filename, fields, load_art)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                tags = _parse_head(data, filename, fields, load_art)
+        if tags is None:
+            return None
+
+        # mutagen fills fields missing from ID3v2 with the ID3v1 tag at the end of the file
+        is_missing_fields = False
+        for field in fields:
+            if getattr(tags, field) is None:
+                is_missing_fields = True
+        if is_missing_fields and filename.lower().endswith(".mp3") and file_size >= 128:
+            f.seek(-128, os.SEEK_END)
+            if f.read(3) == b"TAG":
+                return None
+
+    return tags
+
+
+def prefetch_heads(filenames: List[str]):
+    """
+    Ask the kernel to start reading the start of every file in the background,
+    so a batch scan on a network filesystem doesn't wait on one file at a time.
+    """
+    # posix_fadvise only exists on Linux and a few other Unixes
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, HEAD_READ_SIZE, os.POSIX_FADV_WILLNEED)
+        os.close(fd)
+
+
+def read_tags_fast(filename: str, fields: List[str] = TAG_FIELDS) -> Tags:
+    """
+    Same result as read_tags, but skips mutagen's format detection for the
+    common ID3v2 and FLAC layouts.
+    """
+    for field in fields:
+        if field not in TAG_FIELDS:
+            raise ValueError(f"Unknown tag field '{field}'")
+
+    tags = _parse_tags_in_place(filename, fields, load_art=True)
+    if tags is None:
+        return read_tags(filename, fields)
+    return tags
+
+
+def get_cover_art_handle(filename: str) -> ArtHandle:
+    tags = _parse_tags_in_place(filename, ["cover_art"], load_art=False)
+    if tags is not None:
+        if tags.cover_art is None:
+            raise NoTagError("No cover art found")
+        return tags.cover_art
+
+    audiofile = File(filename)
+    if audiofile is None:
+        raise NoTagError("No tag found")
+
+    if isinstance(audiofile, MP3):
+        apic_frames = [key for key in audiofile.keys() if key.startswith("APIC")]
+        if not apic_frames:
+            raise NoTagError("APIC frame not found")
+        picture = audiofile[apic_frames[0]]
+    else:
+        if not getattr(audiofile, "pictures", None):
+            raise NoTagError("No cover art found")
+        picture = audiofile.pictures[0]
+    return ArtHandle(filename, None, len(picture.data), picture.mime)
+
+
+# Maps (device, inode) to (mtime, size, digest), so a file changed by another
+# program is hashed again. TagTransaction drops the entries of files it saves.
+_art_digest_cache = {}
+
+
+def art_digest(filename: str) -> bytes:
+    """
+    SHA-256 of the first embedded picture. The picture is hashed straight out of
+    a memory map instead of being copied into memory first.
+    """
+    stat = os.stat(filename)
+    cache_key = (stat.st_dev, stat.st_ino)
+    if cache_key in _art_digest_cache:
+        mtime_ns, size, digest = _art_digest_cache[cache_key]
+        if mtime_ns == stat.st_mtime_ns and size == stat.st_size:
+            return digest
+
+    handle = get_cover_art_handle(filename)
+    if handle.offset is None or REMOTE_STORAGE:
+        digest = hashlib.sha256(handle.read()).digest()
+    else:
+        with open(filename, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                with memoryview(data) as view:
+                    art_end = handle.offset + handle.length
+                    with view[handle.offset : art_end] as art:
+                        digest = hashlib.sha256(art).digest()
+
+    _art_digest_cache[cache_key] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+AUDIO_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def audio_digest(filename: str) -> bytes:
+    """
+    Fingerprint of the audio alone, so files that differ only in their tags
+    match. FLAC files that carry the MD5 of their decoded audio in STREAMINFO
+    return that MD5 without reading any further. Otherwise it is the SHA-256
+    of the file with any ID3v2 tags at the start and the ID3v1 and APEv2 tags
+    at the end left out, or for FLAC, of everything after the metadata blocks.
+    """
+    with open(filename, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        start = 0
+        end = file_size
+
+        header = f.read(10)
+        if header[0:4] == b"fLaC":
+            f.seek(4)
+            is_last_block = False
+            while not is_last_block:
+                block_header = f.read(4)
+                if len(block_header) < 4:
+                    break
+                is_last_block = block_header[0] & 0x80
+                block_type = block_header[0] & 0x7F
+                block_length = int.from_bytes(block_header[1:4], "big")
+                block = f.read(block_length)
+                # STREAMINFO is all zeros here when the encoder skipped the MD5
+                if block_type == 0 and block[18:34] != bytes(16):
+                    return block[18:34]
+            start = f.tell()
+        else:
+            # Several ID3v2 tags can be stacked at the start of an MP3
+            while len(header) == 10 and header[0:3] == b"ID3":
+                tag_size = (
+                    (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+                )
+                start += 10 + tag_size
+                if header[5] & 0x10:
+                    # Footer present
+                    start += 10
+                f.seek(start)
+                header = f.read(10)
+
+            if end - start >= 128:
+                f.seek(end - 128)
+                if f.read(3) == b"TAG":
+                    end -= 128
+            if end - start >= 32:
+                f.seek(end - 32)
+                footer = f.read(32)
+                if footer[0:8] == b"APETAGEX":
+                    # The size covers the items and footer but not the optional header
+                    end -= int.from_bytes(footer[12:16], "little")
+                    if int.from_bytes(footer[20:24], "little") & 0x80000000:
+                        end -= 32
+
+        digest = hashlib.sha256()
+        f.seek(start)
+        position = start
+        while position < end:
+            chunk = f.read(min(AUDIO_HASH_CHUNK_SIZE, end - position))
+            if not chunk:
+                break
+            digest.update(chunk)
+            position += len(chunk)
+    return digest.digest()
+
+
 def get_title_and_artist_from_filename(filename):
     audiofile = File(filename)
     if audiofile is None:
@@ -25,26 +525,425 @@ def get_title_and_artist_from_filename(filename):
     return (title, artist)
 
 
-def _read_or_create_tag(filename: str):
+def _read_or_create_tag(filething: Union[str, BinaryIO]):
     try:
-        audiofile = File(filename)
+        audiofile = File(filething)
         if audiofile is None:
-            audiofile = MP3(filename)
+            audiofile = MP3(filething)
             audiofile.add_tags()
         return audiofile
     except OSError:
-        audiofile = MP3(filename)
+        audiofile = MP3(filething)
         audiofile.add_tags()
         return audiofile
 
 
+# Free space reserved after the tag whenever a save has to grow the file anyway,
+# so the next few edits fit in place instead of rewriting the whole file
+TAG_PADDING = 64 * 1024
+
+# Free space above this is given back when a tag shrinks, like when large
+# cover art is swapped for a smaller one
+TAG_MAX_PADDING = 1024 * 1024
+
+
+# Limits used by normalize_art
+ART_MAX_EDGE = 1200
+ART_MAX_BYTES = 500 * 1024
+ART_JPEG_QUALITY = 90
+
+
+def normalize_art(
+    raw_image: bytes, max_edge: int = ART_MAX_EDGE, max_bytes: int = ART_MAX_BYTES
+) -> bytes:
+    """
+    Shrink cover art before embedding it: scale it down to max_edge pixels,
+    re-encode it as a JPEG that fits in max_bytes, and drop EXIF and ICC data.
+    JPEGs that are already small enough and carry no extra data are kept as is.
+    """
+    image = Image.open(BytesIO(raw_image))
+    is_small_enough = max(image.size) <= max_edge and len(raw_image) <= max_bytes
+    has_extra_data = "exif" in image.info or "icc_profile" in image.info
+    if image.format == "JPEG" and is_small_enough and not has_extra_data:
+        return raw_image
+
+    # The EXIF orientation is about to be dropped, so apply it to the pixels
+    image = ImageOps.exif_transpose(image)
+    image = image.convert("RGB")
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    # Lower the quality until the image fits the budget, but not into mush
+    quality = ART_JPEG_QUALITY
+    while True:
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        if output.tell() <= max_bytes or quality <= 40:
+            return output.getvalue()
+        quality -= 10
+
+
+class PreparedArt:
+    """
+    The APIC frame and FLAC Picture for one image, built once so they can be
+    shared by every file that gets the same cover art.
+    """
+
+    def __init__(self, raw_image: bytes):
+        self.digest = hashlib.sha256(raw_image).digest()
+        try:
+            mime = Image.MIME[Image.open(BytesIO(raw_image)).format]
+        except (UnidentifiedImageError, KeyError):
+            mime = "image/jpeg"
+
+        self.apic = APIC(encoding=3, mime=mime, type=3, desc="Cover", data=raw_image)
+        self.picture = Picture()
+        self.picture.data = raw_image
+        self.picture.type = 3  # Cover (front)
+        self.picture.mime = mime
+        self.picture.desc = "Cover"
+
+
+class TagTransaction:
+    """
+    Collects tag changes for one file and saves them all with a single write
+    when the with block ends. Nothing is written if the block raises.
+    After saving, rewrote_file says whether the tag outgrew its padding, or
+    shrank so much that the padding got too big, and the whole file had to be
+    rewritten, rather than updating the tag in place.
+    filething is a filename, or a file object holding the whole audio file.
+    """
+
+    def __init__(self, filething: Union[str, BinaryIO], padding: int = TAG_PADDING):
+        self.filething = filething
+        self.padding = padding
+        self.changes = []
+        self.rewrote_file = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def set(self, field: str, value):
+        if field not in TAG_FIELDS:
+            raise ValueError(f"Unknown tag field '{field}'")
+        if field == "lyrics":
+            value = value.encode("ascii", "ignore").decode()
+        if field == "cover_art" and not isinstance(value, PreparedArt):
+            value = PreparedArt(value)
+        self.changes.append((field, value))
+
+    def clear(self, field: str):
+        if field not in TAG_FIELDS:
+            raise ValueError(f"Unknown tag field '{field}'")
+        self.changes.append((field, None))
+
+    def replace(self, field: str, value):
+        """Clear the field, then set it unless value is None."""
+        self.clear(field)
+        if value is not None:
+            self.set(field, value)
+
+    def commit(self) -> bool:
+        if not self.changes:
+            return False
+
+        audiofile = _read_or_create_tag(self.filething)
+        for field, value in self.changes:
+            if isinstance(audiofile, MP3):
+                self._apply_mp3(audiofile, field, value)
+            else:
+                self._apply_vorbis(audiofile, field, value)
+        if not isinstance(self.filething, str):
+            # Loading leaves the file object wherever mutagen stopped reading
+            self.filething.seek(0)
+        audiofile.save(self.filething, padding=self._choose_padding)
+        self.changes = []
+
+        if isinstance(self.filething, str):
+            # The save may not move the mtime far enough for art_digest to notice
+            stat = os.stat(self.filething)
+            _art_digest_cache.pop((stat.st_dev, stat.st_ino), None)
+        return self.rewrote_file
+
+    def _choose_padding(self, info) -> int:
+        # info.padding is the space left over if the new tag is written in place
+        if 0 <= info.padding <= TAG_MAX_PADDING:
+            self.rewrote_file = False
+            return info.padding
+        self.rewrote_file = True
+        return self.padding
+
+    def _apply_mp3(self, audiofile, field: str, value):
+        if field == "cover_art":
+            frame = "APIC"
+        elif field == "lyrics":
+            frame = "USLT"
+        elif field == "year":
+            frame = "TDRC"
+        else:
+            frame = MP3_TEXT_FRAMES[field]
+
+        if value is None:
+            # Frames like APIC and USLT can appear several times with different keys
+            keys = [key for key in audiofile.keys() if key.split(":")[0] == frame]
+            for key in keys:
+                del audiofile[key]
+        elif field == "cover_art":
+            audiofile["APIC"] = value.apic
+        elif field == "lyrics":
+            audiofile["USLT::eng"] = USLT(encoding=3, lang="eng", desc="", text=value)
+        else:
+            audiofile[frame] = Frames[frame](encoding=3, text=str(value))
+
+    def _apply_vorbis(self, audiofile, field: str, value):
+        if field == "cover_art" and value is None:
+            if hasattr(audiofile, "clear_pictures"):
+                audiofile.clear_pictures()
+        elif field == "cover_art":
+            if hasattr(audiofile, "add_picture"):
+                audiofile.add_picture(value.picture)
+            elif hasattr(audiofile, "pictures"):
+                audiofile.pictures = [value.picture]
+        else:
+            if field == "year":
+                key = "DATE"
+            else:
+                key = VORBIS_TEXT_KEYS[field]
+
+            if key in audiofile:
+                del audiofile[key]
+            if value is not None:
+                audiofile[key] = str(value)
+
+
+# Temp files are hidden next to their target, so os.replace never crosses filesystems
+ATOMIC_TEMP_SUFFIX = ".soundscrape-tmp"
+FSYNC_GROUP_SIZE = 64
+
+
+def _atomic_temp_path(filename: str) -> str:
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, f".{name}{ATOMIC_TEMP_SUFFIX}")
+
+
+class AtomicWriteBatch:
+    """
+    Replaces files so that after a crash or power loss each one holds either
+    its old or its new contents, never a half-written tag. New contents go to
+    a temp file next to the target. Every group_size files the temps are
+    fsynced together, moved over their targets with os.replace, and each
+    directory involved is fsynced once. Safe to use from several threads.
+    Temps still pending when the with block raises are deleted.
+    """
+
+    def __init__(self, group_size: int = FSYNC_GROUP_SIZE):
+        self.group_size = group_size
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def write(self, filename: str, data: bytes, mode_from: Optional[str] = None):
+        """
+        The new file gets the permissions of mode_from, by default those of
+        the file it replaces.
+        """
+        if mode_from is None:
+            mode_from = filename
+        temp_path = _atomic_temp_path(filename)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        if os.path.exists(mode_from):
+            shutil.copymode(mode_from, temp_path)
+
+        with self.lock:
+            self.pending.append((temp_path, filename))
+            if len(self.pending) >= self.group_size:
+                self._flush_pending()
+
+    def flush(self):
+        with self.lock:
+            self._flush_pending()
+
+    def discard(self):
+        with self.lock:
+            for temp_path, _ in self.pending:
+                os.remove(temp_path)
+            self.pending = []
+
+    def _flush_pending(self):
+        # Syncing a whole group back to back lets the disk batch the writes
+        for temp_path, _ in self.pending:
+            fd = os.open(temp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        directories = set()
+        for temp_path, filename in self.pending:
+            os.replace(temp_path, filename)
+            directories.add(os.path.dirname(os.path.abspath(filename)))
+        self.pending = []
+
+        # The renames themselves are only durable once the directory is synced,
+        # which Windows can't do and doesn't need
+        if os.name == "posix":
+            for directory in directories:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+
+def recover_atomic_writes(directory: str) -> List[str]:
+    """
+    Delete temp files left under directory by an AtomicWriteBatch that never
+    finished. Their targets still hold the old contents, so nothing is lost.
+    Returns the paths that were removed.
+    """
+    removed = []
+    for subdirectory, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.startswith(".") and filename.endswith(ATOMIC_TEMP_SUFFIX):
+                path = os.path.join(subdirectory, filename)
+                os.remove(path)
+                removed.append(path)
+    return removed
+
+
+def sync_tags(
+    filename: str, desired: Dict[str, Any], batch: Optional[AtomicWriteBatch] = None
+) -> str:
+    """
+    Make the file's tags match desired. A value of None means the field should
+    be absent and new cover art replaces any existing pictures. Nothing is saved
+    if the file already matches; for cover art only the first picture is compared.
+    With a batch, the new file goes through it instead of being edited in place.
+    Returns "unchanged", "updated" (written in place) or "rewritten".
+    """
+    if "cover_art" in desired and isinstance(desired["cover_art"], bytes):
+        desired = dict(desired)
+        desired["cover_art"] = PreparedArt(desired["cover_art"])
+
+    text_fields = [field for field in desired if field != "cover_art"]
+    try:
+        current = read_tags_fast(filename, text_fields)
+    except NoTagError:
+        current = Tags()
+
+    is_in_sync = True
+    for field, value in desired.items():
+        if field == "cover_art":
+            try:
+                current_digest = art_digest(filename)
+            except NoTagError:
+                current_digest = None
+            if value is None:
+                is_in_sync = is_in_sync and current_digest is None
+            else:
+                is_in_sync = is_in_sync and current_digest == value.digest
+        else:
+            if field == "lyrics" and value is not None:
+                value = value.encode("ascii", "ignore").decode()
+            is_in_sync = is_in_sync and getattr(current, field) == value
+
+    if is_in_sync:
+        return "unchanged"
+
+    if batch is not None:
+        copy_with_tags(filename, filename, desired, batch)
+        return "rewritten"
+
+    with TagTransaction(filename) as transaction:
+        for field, value in desired.items():
+            transaction.replace(field, value)
+    if transaction.rewrote_file:
+        return "rewritten"
+    return "updated"
+
+
+def copy_with_tags(
+    source: str,
+    destination: str,
+    desired: Dict[str, Any],
+    batch: Optional[AtomicWriteBatch] = None,
+):
+    """
+    Copy source to destination with the desired fields applied the same way
+    sync_tags does, so the destination is written once instead of being copied
+    and then retagged. The whole file is read into memory and edited there, so
+    each call holds a copy of one track, which is fine for songs but not for
+    files of several GB. The destination gets the source's permissions. With a
+    batch, the destination is replaced atomically when the batch flushes.
+    """
+    with open(source, "rb") as f:
+        buffer = BytesIO(f.read())
+
+    with TagTransaction(buffer) as transaction:
+        for field, value in desired.items():
+            transaction.replace(field, value)
+
+    if batch is not None:
+        batch.write(destination, buffer.getvalue(), mode_from=source)
+        return
+    with open(destination, "wb") as f:
+        f.write(buffer.getbuffer())
+    shutil.copymode(source, destination)
+
+
+def apply_tags(
+    files: List[str],
+    updates: Dict[str, Any],
+    workers: int = 4,
+    file_updates: Optional[Dict[str, Dict[str, Any]]] = None,
+    atomic: bool = False,
+) -> Dict[str, int]:
+    """
+    Run sync_tags with the same fields on many files. file_updates holds extra
+    fields that differ per file, keyed by filename. Tag writes mostly wait on
+    the disk, so the files are handled on a thread pool. With atomic set, the
+    files are replaced through an AtomicWriteBatch instead of edited in place.
+    Returns how many files ended up "unchanged", "updated" and "rewritten".
+    """
+    if "cover_art" in updates and isinstance(updates["cover_art"], bytes):
+        updates = dict(updates)
+        updates["cover_art"] = PreparedArt(updates["cover_art"])
+
+    def sync_file(filename: str) -> str:
+        all_updates = dict(updates)
+        if file_updates is not None and filename in file_updates:
+            all_updates.update(file_updates[filename])
+        return sync_tags(filename, all_updates, batch)
+
+    # Without atomic set, batch is None and files are edited in place
+    batch_context = nullcontext()
+    if atomic:
+        batch_context = AtomicWriteBatch()
+    with batch_context as batch:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(sync_file, files))
+
+    counts = {}
+    for result in ["unchanged", "updated", "rewritten"]:
+        counts[result] = results.count(result)
+    return counts
+
+
 def set_year(filename: str, year: int):
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["TDRC"] = TDRC(encoding=3, text=str(year))
-    else:
-        audiofile["DATE"] = str(year)
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("year", year)
 
 
 def get_year(filename: str) -> int:
@@ -65,26 +964,13 @@ def get_year(filename: str) -> int:
 
 
 def clear_year(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        raise NoTagError("No tag found")
-
-    if isinstance(audiofile, MP3):
-        if "TDRC" in audiofile:
-            del audiofile["TDRC"]
-    else:
-        if "DATE" in audiofile:
-            del audiofile["DATE"]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("year")
 
 
 def set_album_title(filename: str, album_title: str):
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["TALB"] = TALB(encoding=3, text=album_title)
-    else:
-        audiofile["ALBUM"] = album_title
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("album", album_title)
 
 
 def get_album_title(filename: str) -> str:
@@ -104,26 +990,13 @@ def get_album_title(filename: str) -> str:
 
 
 def clear_album_title(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        raise NoTagError("No tag found")
-
-    if isinstance(audiofile, MP3):
-        if "TALB" in audiofile:
-            del audiofile["TALB"]
-    else:
-        if "ALBUM" in audiofile:
-            del audiofile["ALBUM"]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("album")
 
 
 def set_artist(filename: str, artist: str):
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["TPE1"] = TPE1(encoding=3, text=artist)
-    else:
-        audiofile["ARTIST"] = artist
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("artist", artist)
 
 
 def get_artist(filename: str) -> str:
@@ -143,26 +1016,13 @@ def get_artist(filename: str) -> str:
 
 
 def clear_artist(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        raise NoTagError("No tag found")
-
-    if isinstance(audiofile, MP3):
-        if "TPE1" in audiofile:
-            del audiofile["TPE1"]
-    else:
-        if "ARTIST" in audiofile:
-            del audiofile["ARTIST"]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("artist")
 
 
 def set_album_artist(filename: str, album_artist: str):
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["TPE2"] = TPE2(encoding=3, text=album_artist)
-    else:
-        audiofile["ALBUMARTIST"] = album_artist
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("album_artist", album_artist)
 
 
 def get_album_artist(filename: str) -> str:
@@ -182,26 +1042,13 @@ def get_album_artist(filename: str) -> str:
 
 
 def clear_album_artist(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        raise NoTagError("No tag found")
-
-    if isinstance(audiofile, MP3):
-        if "TPE2" in audiofile:
-            del audiofile["TPE2"]
-    else:
-        if "ALBUMARTIST" in audiofile:
-            del audiofile["ALBUMARTIST"]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("album_artist")
 
 
 def set_song_title(filename: str, song_title: str):
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["TIT2"] = TIT2(encoding=3, text=song_title)
-    else:
-        audiofile["TITLE"] = song_title
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("title", song_title)
 
 
 def get_song_title(filename: str) -> str:
@@ -221,29 +1068,13 @@ def get_song_title(filename: str) -> str:
 
 
 def clear_song_title(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        raise NoTagError("No tag found")
-
-    if isinstance(audiofile, MP3):
-        if "TIT2" in audiofile:
-            del audiofile["TIT2"]
-    else:
-        if "TITLE" in audiofile:
-            del audiofile["TITLE"]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("title")
 
 
 def set_lyrics(filename: str, lyrics: str):
-    ascii_lyrics = lyrics.encode("ascii", "ignore")
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["USLT::eng"] = USLT(
-            encoding=3, lang="eng", desc="", text=ascii_lyrics.decode()
-        )
-    else:
-        audiofile["LYRICS"] = ascii_lyrics.decode()
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("lyrics", lyrics)
 
 
 def get_lyrics(filename: str) -> str:
@@ -265,19 +1096,8 @@ def get_lyrics(filename: str) -> str:
 
 
 def clear_lyrics(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        return
-
-    if isinstance(audiofile, MP3):
-        # Remove all USLT frames
-        uslt_frames = [key for key in audiofile.keys() if key.startswith("USLT")]
-        for key in uslt_frames:
-            del audiofile[key]
-    else:
-        if "LYRICS" in audiofile:
-            del audiofile["LYRICS"]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("lyrics")
 
 
 def get_cover_art(filename: str) -> bytes:
@@ -301,42 +1121,13 @@ def get_cover_art(filename: str) -> bytes:
 
 
 def set_cover_art(filename: str, raw_image: bytes):
-    audiofile = _read_or_create_tag(filename)
-    if isinstance(audiofile, MP3):
-        audiofile["APIC"] = APIC(
-            encoding=3, mime="image/jpeg", type=3, desc="Cover", data=raw_image
-        )
-    else:
-        # For FLAC files, we need to handle pictures differently
-        from mutagen.flac import Picture
-
-        picture = Picture()
-        picture.data = raw_image
-        picture.type = 3  # Cover (front)
-        picture.mime = "image/jpeg"
-        picture.desc = "Cover"
-        if hasattr(audiofile, "add_picture"):
-            audiofile.add_picture(picture)
-        elif hasattr(audiofile, "pictures"):
-            audiofile.pictures = [picture]
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.set("cover_art", raw_image)
 
 
 def clear_cover_art(filename: str):
-    audiofile = File(filename)
-    if audiofile is None:
-        return
-
-    if isinstance(audiofile, MP3):
-        # Remove all APIC frames
-        keys_to_remove = [key for key in audiofile.keys() if key.startswith("APIC")]
-        for key in keys_to_remove:
-            del audiofile[key]
-    else:
-        # For FLAC and other formats
-        if hasattr(audiofile, "clear_pictures"):
-            audiofile.clear_pictures()
-    audiofile.save()
+    with TagTransaction(filename) as transaction:
+        transaction.clear("cover_art")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,287 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from fnmatch import fnmatch
+import hashlib
+import os
+import sqlite3
+import sys
+from typing import Iterator, List, Optional
+
+import file_metadata
+from file_metadata import (
+    NoTagError,
+    Tags,
+    audio_digest,
+    prefetch_heads,
+    read_tags_fast,
+)
+
+
+INDEX_FILENAME = "library_index.sqlite"
+
+# How many changed files get their readahead requested together during a scan
+PREFETCH_BATCH_SIZE = 64
+
+TAG_COLUMNS = ["title", "artist", "album", "album_artist", "year", "lyrics"]
+
+
+def iter_audio_files(
+    root: str,
+    recursive: bool = True,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+) -> Iterator[os.DirEntry]:
+    """
+    Yield a DirEntry for every MP3 and FLAC file under root, reading one
+    directory at a time so memory use doesn't grow with the library. include
+    and exclude are glob patterns matched against the path relative to root,
+    like "Live/*"; excluded folders aren't entered at all. entry.stat() is
+    cached, so callers can check size and mtime without another system call.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, root)
+                if exclude is not None:
+                    is_excluded = False
+                    for pattern in exclude:
+                        if fnmatch(relative_path, pattern):
+                            is_excluded = True
+                    if is_excluded:
+                        continue
+
+                # Symlinked folders aren't followed, like os.walk, so a link
+                # loop can't be walked forever
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        directories.append(entry.path)
+                    continue
+
+                if not entry.name.lower().endswith((".mp3", ".flac")):
+                    continue
+                if include is not None:
+                    is_included = False
+                    for pattern in include:
+                        if fnmatch(relative_path, pattern):
+                            is_included = True
+                    if not is_included:
+                        continue
+                yield entry
+
+
+INSERT_TRACK = (
+    "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def read_track(path: str, processed: bool = False) -> tuple:
+    """
+    Read one file into a row of the tracks table. Only digests of the art and
+    audio are kept, so rows are small enough to pass back from worker processes.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    # The art is read along with the text tags, so in remote storage mode the
+    # whole tag comes from one large read
+    try:
+        tags = read_tags_fast(path, TAG_COLUMNS + ["cover_art"])
+    except NoTagError:
+        tags = Tags()
+    digest = None
+    if tags.cover_art is not None:
+        digest = hashlib.sha256(tags.cover_art).digest()
+
+    return (
+        path,
+        os.path.dirname(path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        tags.title,
+        tags.artist,
+        tags.album,
+        tags.album_artist,
+        tags.year,
+        tags.lyrics,
+        digest,
+        processed,
+        audio_digest(path),
+    )
+
+
+def _set_remote_storage(remote_storage: bool):
+    # Worker processes don't always inherit settings changed after import
+    file_metadata.REMOTE_STORAGE = remote_storage
+
+
+@dataclass
+class IndexedTrack:
+    path: str
+    tags: Tags
+    art_digest: Optional[bytes]
+    processed: bool
+    audio_digest: Optional[bytes]
+
+
+class LibraryIndex:
+    """
+    SQLite catalog of audio files, their tags and a fingerprint of their audio.
+    scan() only re-reads files whose size or modification time changed since
+    the last scan.
+    """
+
+    def __init__(self, database_path: str):
+        self.connection = sqlite3.connect(database_path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                album_artist TEXT,
+                year INTEGER,
+                lyrics TEXT,
+                art_digest BLOB,
+                processed INTEGER NOT NULL DEFAULT 0,
+                audio_digest BLOB
+            )
+            """
+        )
+        columns = []
+        for row in self.connection.execute("PRAGMA table_info(tracks)"):
+            columns.append(row[1])
+        if "audio_digest" not in columns:
+            # Index from before audio fingerprints, make the next scan read every file again
+            self.connection.execute("ALTER TABLE tracks ADD COLUMN audio_digest BLOB")
+            self.connection.execute("UPDATE tracks SET size = -1")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tracks_directory ON tracks (directory)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tracks_audio_digest ON tracks (audio_digest)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def scan(
+        self,
+        root: str,
+        workers: int = 1,
+        use_processes: bool = False,
+        include: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+    ) -> int:
+        """
+        Bring the index up to date with the files under root, filtered the same
+        way as iter_audio_files. Returns how many files were read. Files are
+        read on a pool of worker threads, or worker processes if use_processes
+        is set, and written to the index here.
+        """
+        root = os.path.abspath(root)
+        known = {}
+        rows = self.connection.execute("SELECT path, size, mtime_ns FROM tracks")
+        for path, size, mtime_ns in rows:
+            if path.startswith(root + os.sep):
+                known[path] = (size, mtime_ns)
+
+        changed = []
+        for entry in iter_audio_files(root, include=include, exclude=exclude):
+            stat = entry.stat()
+            if known.pop(entry.path, None) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            changed.append(entry.path)
+
+        if use_processes:
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_set_remote_storage,
+                initargs=(file_metadata.REMOTE_STORAGE,),
+            )
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            for start in range(0, len(changed), PREFETCH_BATCH_SIZE):
+                batch = changed[start : start + PREFETCH_BATCH_SIZE]
+                prefetch_heads(batch)
+                rows = executor.map(read_track, batch)
+                self.connection.executemany(INSERT_TRACK, rows)
+
+        # Whatever is left in known has been deleted or moved
+        for path in known:
+            self.remove(path)
+
+        self.connection.commit()
+        return len(changed)
+
+    def record(self, path: str, processed: bool = False):
+        self.connection.execute(INSERT_TRACK, read_track(path, processed))
+
+    def remove(self, path: str):
+        path = os.path.abspath(path)
+        self.connection.execute("DELETE FROM tracks WHERE path = ?", (path,))
+
+    def tracks_in(self, directory: str, recursive: bool = False) -> List[IndexedTrack]:
+        """Tracks inside directory, and in its subdirectories if recursive is set."""
+        directory = os.path.abspath(directory)
+        if recursive:
+            # Matches the directory itself and everything whose path starts with it
+            rows = self.connection.execute(
+                f"SELECT path, {', '.join(TAG_COLUMNS)}, art_digest, processed, audio_digest "
+                "FROM tracks WHERE directory = ? OR substr(directory, 1, ?) = ? ORDER BY path",
+                (directory, len(directory + os.sep), directory + os.sep),
+            )
+        else:
+            rows = self.connection.execute(
+                f"SELECT path, {', '.join(TAG_COLUMNS)}, art_digest, processed, audio_digest "
+                "FROM tracks WHERE directory = ? ORDER BY path",
+                (directory,),
+            )
+
+        tracks = []
+        for row in rows:
+            tags = Tags(
+                title=row[1],
+                artist=row[2],
+                album=row[3],
+                album_artist=row[4],
+                year=row[5],
+                lyrics=row[6],
+            )
+            tracks.append(IndexedTrack(row[0], tags, row[7], bool(row[8]), row[9]))
+        return tracks
+
+    def paths_with_audio(self, digest: bytes) -> List[str]:
+        """Every indexed file holding the same recording, whatever its tags say."""
+        rows = self.connection.execute(
+            "SELECT path FROM tracks WHERE audio_digest = ? ORDER BY path", (digest,)
+        )
+        return [row[0] for row in rows]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python library_index.py <library folder> [index file]")
+        sys.exit(1)
+
+    root = sys.argv[1]
+    if len(sys.argv) > 2:
+        database_path = sys.argv[2]
+    else:
+        database_path = os.path.join(root, INDEX_FILENAME)
+
+    with LibraryIndex(database_path) as index:
+        files_read = index.scan(root)
+    print(f"Read tags from {files_read} new or changed files.")
@@ -1,26 +1,46 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
 import hashlib
+import json
 import os
 import shutil
 import sys
-from typing import Dict, List
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 
+from art_auto_selector import auto_select_art
 from art_search import search_cover_art_by_text
 from art_selector import CoverArtSelector
+import file_metadata
+from file_copy import copy_files, file_sha256
 from file_metadata import (
-    clear_cover_art,
-    get_album_title,
-    get_artist,
-    get_cover_art,
-    get_song_title,
-    set_artist,
-    set_cover_art,
-    set_song_title,
+    ArtHandle,
+    AtomicWriteBatch,
+    NoTagError,
+    PreparedArt,
+    apply_tags,
+    copy_with_tags,
+    get_cover_art_handle,
+    normalize_art,
+    recover_atomic_writes,
+    sync_tags,
 )
+from library_index import INDEX_FILENAME, LibraryIndex, iter_audio_files
 from lyrics import clean_title
 from parse_and_clean import parse_artists, parse_features
 
 
+# How many album art searches run at the same time
+ART_SEARCH_WORKERS = 8
+
+# How many albums ahead of the open window get their selector built. Each one
+# holds its album's art zoomed in, which can take hundreds of MB
+SELECTORS_AHEAD = 2
+
+
 @dataclass
 class Track:
     artists: List[str]
@@ -40,8 +60,10 @@ class Album:
     title: str
     artists: List[str]
     tracks: List[Track]
-    art_choices: List[bytes]
+    art_choices: List[Union[bytes, ArtHandle]]
     art_choice_hashes: List[bytes]
+    # Where each choice came from, "embedded" or the service that found it
+    art_choice_sources: List[str]
     chosen_art: bytes
 
     def __repr__(self):
@@ -52,42 +74,172 @@ class Album:
         return output
 
 
-def process_dir(output_dir: str):
+PLAN_FILENAME = "plan.json"
+REVIEW_FILENAME = "review_queue.json"
+PLAN_ART_DIRNAME = "plan_art"
+JOURNAL_FILENAME = "process_journal.jsonl"
+JOURNAL_ART_DIRNAME = ".journal_art"
+
+
+class JobJournal:
+    """
+    Append-only log of how far process_dir got with each album, kept in the
+    output folder so a run that crashed can pick up where it stopped. Each
+    line records one finished stage: "art_fetched" and "art_chosen" with the
+    art's SHA-256, and "written" with where each track went. Fetched art is
+    kept next to the log. Both are deleted once a run finishes.
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, JOURNAL_FILENAME)
+        self.art_dir = os.path.join(output_dir, JOURNAL_ART_DIRNAME)
+        self.lock = threading.Lock()
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    # A crash can leave the last line half written
+                    if not line.endswith("\n"):
+                        break
+                    entry = json.loads(line)
+                    self.stages[(entry["album"], entry["stage"])] = entry
+
+    def get(self, album: str, stage: str) -> Optional[Dict]:
+        return self.stages.get((album, stage))
+
+    def record(self, album: str, stage: str, **details):
+        entry = {"album": album, "stage": stage}
+        entry.update(details)
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.stages[(album, stage)] = entry
+
+    def save_art(self, album: str, art: bytes):
+        digest = hashlib.sha256(art).hexdigest()
+        os.makedirs(self.art_dir, exist_ok=True)
+        with open(os.path.join(self.art_dir, digest), "wb") as f:
+            f.write(art)
+        self.record(album, "art_fetched", digest=digest)
+
+    def load_art(self, digest: str) -> bytes:
+        with open(os.path.join(self.art_dir, digest), "rb") as f:
+            return f.read()
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if os.path.exists(self.art_dir):
+            shutil.rmtree(self.art_dir)
+
+
+def process_dir(
+    output_dir: str,
+    index_path: Optional[str] = None,
+    shrink_art: bool = False,
+    source_dir: Optional[str] = None,
+    atomic: bool = False,
+    skip_duplicates: bool = True,
+    scan_workers: int = os.cpu_count(),
+    scan_with_processes: bool = True,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    skip_processed: bool = False,
+    dry_run: bool = False,
+    plan_path: Optional[str] = None,
+    auto_select: bool = False,
+) -> Dict[str, str]:
+    """
+    Group the tracks under output_dir into albums, pick art for each album,
+    then rename and retag the tracks. If source_dir is given, the tracks are
+    read from there and written into the same subfolders of output_dir.
+    Progress is journaled in output_dir, so a run that crashed picks up where
+    it stopped. Returns the path each processed track was written to, keyed
+    by its old path.
+    """
+    for temp_path in recover_atomic_writes(output_dir):
+        print(f"Removed unfinished write {temp_path}")
+
+    if source_dir is None:
+        source_dir = output_dir
+    # The index stores absolute paths
+    source_dir = os.path.abspath(source_dir)
+    output_dir = os.path.abspath(output_dir)
+    # A dry run keeps its index and journal aside, so the next real run neither
+    # sees the input's tracks nor loses the journal of a run that crashed
+    state_dir = output_dir
+    if dry_run:
+        state_dir = tempfile.mkdtemp()
+    if index_path is None:
+        index_path = os.path.join(state_dir, INDEX_FILENAME)
+    index = LibraryIndex(index_path)
+    journal = JobJournal(state_dir)
+    # The albums left for review last time are looked at again
+    review_path = os.path.join(output_dir, REVIEW_FILENAME)
+    if not dry_run and os.path.exists(review_path):
+        os.remove(review_path)
+    index.scan(source_dir, scan_workers, scan_with_processes, include, exclude)
+
     albums: Dict[str, Album] = {}
-    for filename in os.listdir(output_dir):
-        if filename.lower().endswith((".mp3", ".flac")):
-            filepath = os.path.join(output_dir, filename)
-            artist = get_artist(filepath)
-            title = get_song_title(filepath)
-            album_name = get_album_title(filepath)
-
-            print(f"{artist} - {title} ({album_name})")
-            if album_name not in albums.keys():
-                albums[album_name] = Album(
-                    title=album_name,
-                    artists=[],
-                    tracks=[],
-                    art_choices=[],
-                    art_choice_hashes=[],
-                    chosen_art=b"",
-                )
-
-            cleaned_title = clean_title(title)
-            albums[album_name].tracks.append(
-                Track(
-                    artists=parse_artists(artist),
-                    title=cleaned_title,
-                    features=parse_features(title),
-                    filepath=filepath,
-                )
+    indexed_tracks = index.tracks_in(source_dir, recursive=True)
+    kept_paths = set()
+    if skip_processed:
+        for indexed_track in indexed_tracks:
+            if indexed_track.processed:
+                kept_paths.add(indexed_track.path)
+
+    for indexed_track in indexed_tracks:
+        filepath = indexed_track.path
+        if skip_processed and indexed_track.processed:
+            continue
+        duplicate_of = None
+        for other_path in index.paths_with_audio(indexed_track.audio_digest):
+            is_elsewhere = not other_path.startswith(source_dir + os.sep)
+            if other_path in kept_paths or is_elsewhere:
+                duplicate_of = other_path
+        if duplicate_of is not None:
+            print(f"{filepath} is the same recording as {duplicate_of}")
+            if skip_duplicates:
+                continue
+        kept_paths.add(filepath)
+
+        artist = indexed_track.tags.artist
+        title = indexed_track.tags.title
+        album_name = indexed_track.tags.album
+        if artist is None or title is None or album_name is None:
+            raise NoTagError(f"Artist, title or album missing in {filepath}")
+        if indexed_track.art_digest is None:
+            raise NoTagError(f"No cover art found in {filepath}")
+
+        print(f"{artist} - {title} ({album_name})")
+        if album_name not in albums.keys():
+            albums[album_name] = Album(
+                title=album_name,
+                artists=[],
+                tracks=[],
+                art_choices=[],
+                art_choice_hashes=[],
+                art_choice_sources=[],
+                chosen_art=b"",
             )
-            # Hash each new cover artwork so we can check for duplicates without doing a byte-by-byte comparison between all the images
-            art = get_cover_art(filepath)
-            hash = hashlib.sha256(art).digest()
 
-            if hash not in albums[album_name].art_choice_hashes:
-                albums[album_name].art_choices.append(art)
-                albums[album_name].art_choice_hashes.append(hash)
+        cleaned_title = clean_title(title)
+        albums[album_name].tracks.append(
+            Track(
+                artists=parse_artists(artist),
+                title=cleaned_title,
+                features=parse_features(title),
+                filepath=filepath,
+            )
+        )
+        # The index keeps a hash of each cover artwork so we can check for duplicates without doing a byte-by-byte comparison between all the images
+        hash = indexed_track.art_digest
+
+        if hash not in albums[album_name].art_choice_hashes:
+            art = get_cover_art_handle(filepath)
+            albums[album_name].art_choices.append(art)
+            albums[album_name].art_choice_hashes.append(hash)
+            albums[album_name].art_choice_sources.append("embedded")
 
     for album in albums.values():
         # Set album artists to artists who appear in every track
@@ -102,78 +254,619 @@ def process_dir(output_dir: str):
         if not album.artists:
             album.artists = ["Various Artists"]
 
-        searched_art = search_cover_art_by_text(
-            ", ".join(album.artists), album.title, True
-        )
-        hash = hashlib.sha256(searched_art).digest()
-        album.art_choices.append(searched_art)
-        album.art_choice_hashes.append(hash)
-
     for album in albums.values():
         print(album)
 
+    pending_albums = []
+    finished_paths = []
     for album in albums.values():
-        selector = CoverArtSelector(album.art_choices)
-        chosen_art = album.art_choices[selector.show_selection_window()]
-        for track in album.tracks:
-            if track.features:
-                new_filename_base = f"{track.title} (feat. {', '.join(track.features)})"
-            else:
-                new_filename_base = track.title
-
-            original_extension = os.path.splitext(track.filepath)[1]
-            new_filename = f"{new_filename_base}{original_extension}"
-            new_filepath = os.path.join(os.path.dirname(track.filepath), new_filename)
-
-            os.rename(track.filepath, new_filepath)
-
-            artist_string = "; ".join(track.artists)
-            set_artist(new_filepath, artist_string)
-
-            set_song_title(new_filepath, new_filename_base)
-
-            clear_cover_art(new_filepath)
-            set_cover_art(new_filepath, chosen_art)
+        written = journal.get(album.title, "written")
+        if written is None:
+            pending_albums.append(album)
+        else:
+            print(f"{album.title} was finished by an earlier run")
+            finished_paths.append(written["files"])
+
+    plan = {
+        "source_dir": source_dir,
+        "output_dir": output_dir,
+        "atomic": atomic,
+        "shrink_art": shrink_art,
+        "art_dir": os.path.join(output_dir, PLAN_ART_DIRNAME),
+        "albums": [],
+        "copies": [],
+    }
+    os.makedirs(plan["art_dir"], exist_ok=True)
+
+    written_albums, review_queue = choose_art_and_write(
+        pending_albums, plan, journal, auto_select, dry_run
+    )
+    finished_paths.extend(written_albums)
+
+    if source_dir != output_dir:
+        # Tracks that won't be written, like duplicates, still belong in the
+        # landing zone
+        planned_paths = set()
+        for album_paths in finished_paths:
+            planned_paths.update(album_paths.keys())
+        for album_plan in plan["albums"]:
+            for track_plan in album_plan["tracks"]:
+                planned_paths.add(track_plan["source"])
+        for indexed_track in indexed_tracks:
+            if indexed_track.path not in planned_paths:
+                relative_path = os.path.relpath(indexed_track.path, source_dir)
+                copy_path = os.path.join(output_dir, relative_path)
+                plan["copies"].append([indexed_track.path, copy_path])
+
+    if review_queue and dry_run:
+        for album in review_queue:
+            print(f"{album.title} would be left for review")
+    elif review_queue:
+        # Tracks left for review stay at, or are copied to, the same path in
+        # the landing zone
+        review = []
+        for album in review_queue:
+            track_paths = []
+            for track in album.tracks:
+                relative_path = os.path.relpath(track.filepath, source_dir)
+                track_paths.append(os.path.join(output_dir, relative_path))
+            review.append({"album": album.title, "tracks": track_paths})
+        with open(review_path, "w") as f:
+            json.dump(review, f, indent=2)
+        print(
+            f"{len(review_queue)} albums need their art picked by hand, see {review_path}"
+        )
 
+    if dry_run:
+        if plan_path is None:
+            plan_path = os.path.join(output_dir, PLAN_FILENAME)
+        with open(plan_path, "w") as f:
+            json.dump(plan, f, indent=2)
+        for album_plan in plan["albums"]:
+            print(f"{album_plan['title']} (art {album_plan['art'][:12]}):")
+            for track_plan in album_plan["tracks"]:
+                print(f" {track_plan['source']} -> {track_plan['destination']}")
+        print(f"Saved the plan to {plan_path}, nothing was written.")
+        index.close()
+        shutil.rmtree(state_dir)
+        return {}
+
+    # The index can only be used from this thread
+    written_paths = {}
+    for album_paths in finished_paths:
+        for old_path, new_path in album_paths.items():
+            if source_dir == output_dir:
+                index.remove(old_path)
+            index.record(new_path, processed=True)
+            written_paths[old_path] = new_path
+
+    for source, destination in plan["copies"]:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+    copy_files(plan["copies"])
+
+    index.close()
+    journal.finish()
+    shutil.rmtree(plan["art_dir"])
+    return written_paths
+
+
+def choose_art_and_write(
+    pending_albums: List[Album],
+    plan: Dict,
+    journal: JobJournal,
+    auto_select: bool = False,
+    dry_run: bool = False,
+) -> Tuple[List[Dict[str, str]], List[Album]]:
+    """
+    Fetch art for each album, have it picked, and add the album to the plan.
+    The selection window has to run on this thread. Meanwhile the art for
+    every album is fetched, the selectors for the next few are built, and the
+    albums already decided are written unless this is a dry run, in the
+    background. Returns the paths written for each album and the albums left
+    for review.
+    """
+
+    def fetch_art_choices(album: Album):
+        fetched = journal.get(album.title, "art_fetched")
+        if fetched is None:
+            searched_art = search_cover_art_by_text(
+                ", ".join(album.artists), album.title, True
+            )
+            journal.save_art(album.title, searched_art)
+        else:
+            searched_art = journal.load_art(fetched["digest"])
+        hash = hashlib.sha256(searched_art).digest()
+        album.art_choices.append(searched_art)
+        album.art_choice_hashes.append(hash)
+        album.art_choice_sources.append("spotify")
+
+    def build_selector(album_index: int) -> CoverArtSelector:
+        searches[album_index].result()
+        return CoverArtSelector(pending_albums[album_index].art_choices)
+
+    def write_album(album_plan: Dict) -> Dict[str, str]:
+        album_paths = apply_album(album_plan, plan)
+        journal.record(album_plan["title"], "written", files=album_paths)
+        return album_paths
+
+    writes = []
+    review_queue = []
+    # Selectors are built on their own threads, so they don't wait behind the
+    # searches for later albums
+    with ThreadPoolExecutor(max_workers=ART_SEARCH_WORKERS) as fetcher:
+        with ThreadPoolExecutor(max_workers=SELECTORS_AHEAD) as builder:
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                searches = []
+                for album in pending_albums:
+                    searches.append(fetcher.submit(fetch_art_choices, album))
+
+                selectors = {}
+                for i, album in enumerate(pending_albums):
+                    if not auto_select:
+                        last = min(i + SELECTORS_AHEAD, len(pending_albums) - 1)
+                        for j in range(i, last + 1):
+                            if j not in selectors:
+                                selectors[j] = builder.submit(build_selector, j)
+                    searches[i].result()
+                    selector = selectors.pop(i, None)
+                    choice = None
+                    chosen = journal.get(album.title, "art_chosen")
+                    if chosen is not None:
+                        for choice_index, hash in enumerate(album.art_choice_hashes):
+                            if hash.hex() == chosen["digest"]:
+                                choice = choice_index
+                    if choice is None and auto_select:
+                        choice, is_confident = auto_select_art(
+                            album.art_choices, album.art_choice_sources
+                        )
+                        if not is_confident:
+                            print(
+                                f"Not sure about the art for {album.title}, left for review"
+                            )
+                            review_queue.append(album)
+                            continue
+                        digest = album.art_choice_hashes[choice].hex()
+                        journal.record(album.title, "art_chosen", digest=digest)
+                    if choice is None:
+                        choice = selector.result().show_selection_window()
+                        digest = album.art_choice_hashes[choice].hex()
+                        journal.record(album.title, "art_chosen", digest=digest)
+
+                    chosen_art = album.art_choices[choice]
+                    if isinstance(chosen_art, ArtHandle):
+                        chosen_art = chosen_art.read()
+                    album_plan = plan_album(
+                        album, chosen_art, plan["source_dir"], plan["output_dir"]
+                    )
+                    # Albums can share art, which the writer may be reading, so the
+                    # file is replaced rather than rewritten
+                    art_path = os.path.join(plan["art_dir"], album_plan["art"])
+                    with open(art_path + ".tmp", "wb") as f:
+                        f.write(chosen_art)
+                    os.replace(art_path + ".tmp", art_path)
+                    plan["albums"].append(album_plan)
+                    if not dry_run:
+                        writes.append(writer.submit(write_album, album_plan))
+
+    written = []
+    for write in writes:
+        written.append(write.result())
+    return written, review_queue
+
+
+def plan_album(
+    album: Album, chosen_art: bytes, source_dir: str, output_dir: str
+) -> Dict:
+    """
+    Work out where each track of the album goes and which tags it gets.
+    The chosen art is referenced by its SHA-256.
+    """
+    track_plans = []
+    for track in album.tracks:
+        if track.features:
+            new_filename_base = f"{track.title} (feat. {', '.join(track.features)})"
+        else:
+            new_filename_base = track.title
+
+        original_extension = os.path.splitext(track.filepath)[1]
+        new_filename = f"{new_filename_base}{original_extension}"
+        relative_dir = os.path.relpath(os.path.dirname(track.filepath), source_dir)
+        new_dir = os.path.normpath(os.path.join(output_dir, relative_dir))
+        track_plans.append(
+            {
+                "source": track.filepath,
+                "destination": os.path.join(new_dir, new_filename),
+                "tags": {
+                    "artist": "; ".join(track.artists),
+                    "title": new_filename_base,
+                },
+            }
+        )
 
-def main(input_path: str, output_path: str, no_processing: bool = False):
+    return {
+        "title": album.title,
+        "art": hashlib.sha256(chosen_art).hexdigest(),
+        "tracks": track_plans,
+    }
+
+
+def apply_album(album_plan: Dict, plan: Dict) -> Dict[str, str]:
+    """
+    Rename and retag one album's tracks as planned.
+    Returns the path each track was written to, keyed by its old path.
+    """
+    with open(os.path.join(plan["art_dir"], album_plan["art"]), "rb") as f:
+        chosen_art = f.read()
+    if plan["shrink_art"]:
+        chosen_art = normalize_art(chosen_art)
+    prepared_art = PreparedArt(chosen_art)
+    is_in_place = plan["source_dir"] == plan["output_dir"]
+
+    new_filepaths = []
+    album_paths = {}
+    file_updates = {}
+    # Without atomic set, batch is None and files are edited in place
+    batch_context = nullcontext()
+    if plan["atomic"]:
+        batch_context = AtomicWriteBatch()
+    with batch_context as batch:
+        for track_plan in album_plan["tracks"]:
+            source = track_plan["source"]
+            new_filepath = track_plan["destination"]
+            new_tags = dict(track_plan["tags"])
+            os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
+
+            if is_in_place and not plan["atomic"]:
+                os.rename(source, new_filepath)
+                file_updates[new_filepath] = new_tags
+            elif source == new_filepath:
+                # Only rewritten if the tags or art changed
+                new_tags["cover_art"] = prepared_art
+                sync_tags(source, new_tags, batch)
+            else:
+                new_tags["cover_art"] = prepared_art
+                copy_with_tags(source, new_filepath, new_tags, batch)
+            new_filepaths.append(new_filepath)
+            album_paths[source] = new_filepath
+
+    if is_in_place and plan["atomic"]:
+        # The renamed copies are safely on disk, so the originals can go
+        for source, new_filepath in album_paths.items():
+            if not os.path.samefile(source, new_filepath):
+                os.remove(source)
+    elif is_in_place:
+        counts = apply_tags(
+            new_filepaths, {"cover_art": prepared_art}, file_updates=file_updates
+        )
+        files_written = counts["updated"] + counts["rewritten"]
+        print(f"Wrote tags to {files_written} of {len(new_filepaths)} files.")
+    return album_paths
+
+
+def apply_plan(plan: Dict, workers: int = 4) -> Dict[str, str]:
+    """
+    Carry out a plan saved by a process_dir dry run, several albums at a time.
+    Returns the path each track was written to, keyed by its old path.
+    """
+
+    def apply_one(album_plan: Dict) -> Dict[str, str]:
+        return apply_album(album_plan, plan)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(apply_one, plan["albums"]))
+    for source, destination in plan["copies"]:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+    copy_files(plan["copies"])
+
+    written_paths = {}
+    for album_paths in results:
+        written_paths.update(album_paths)
+    return written_paths
+
+
+MANIFEST_FILENAME = "sync_manifest.json"
+
+
+def sync_landing_zone(
+    input_path: str,
+    output_path: str,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+) -> Dict[str, Dict]:
+    """
+    Bring the landing zone up to date with input_path instead of starting over.
+    A manifest in the landing zone records the size, mtime and SHA-256 of every
+    source file and where its copy is. Unchanged files are skipped, new and
+    changed files copied, and the copies of deleted files removed.
+    Returns the manifest, keyed by path relative to input_path.
+    """
+    manifest_path = os.path.join(output_path, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    copies = []
+    source_digests = {}
+    seen = set()
+    for entry in iter_audio_files(input_path, include=include, exclude=exclude):
+        relative_path = os.path.relpath(entry.path, input_path)
+        seen.add(relative_path)
+        stat = entry.stat()
+        old_entry = manifest.get(relative_path)
+        if old_entry is not None:
+            is_same_size = old_entry["size"] == stat.st_size
+            if is_same_size and old_entry["mtime_ns"] == stat.st_mtime_ns:
+                continue
+
+        new_entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_sha256(entry.path),
+            "output": relative_path,
+        }
+
+        if old_entry is not None:
+            if old_entry["sha256"] == new_entry["sha256"]:
+                # Only touched, the copy is still good
+                new_entry["output"] = old_entry["output"]
+                manifest[relative_path] = new_entry
+                continue
+            old_output = os.path.join(output_path, old_entry["output"])
+            if os.path.exists(old_output):
+                os.remove(old_output)
+
+        output_filename = os.path.join(output_path, relative_path)
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        copies.append((entry.path, output_filename))
+        # The copy is checked against this hash instead of hashing the source again
+        source_digests[entry.path] = new_entry["sha256"]
+        manifest[relative_path] = new_entry
+    copy_files(copies, source_digests=source_digests)
+
+    files_removed = 0
+    for relative_path in list(manifest.keys()):
+        if relative_path not in seen:
+            old_output = os.path.join(output_path, manifest[relative_path]["output"])
+            if os.path.exists(old_output):
+                os.remove(old_output)
+            del manifest[relative_path]
+            files_removed += 1
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Copied {len(copies)} new or changed files, removed {files_removed}.")
+    return manifest
+
+
+def main(
+    input_path: str,
+    output_path: str,
+    no_processing: bool = False,
+    retag_while_copying: bool = False,
+    atomic: bool = False,
+    skip_duplicates: bool = True,
+    scan_workers: int = os.cpu_count(),
+    scan_with_processes: bool = True,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    incremental: bool = False,
+    dry_run: bool = False,
+    plan_path: Optional[str] = None,
+    auto_select: bool = False,
+    shrink_art: bool = False,
+):
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input path '{input_path}' does not exist")
 
     if not os.path.isdir(input_path):
         raise ValueError(f"Input path '{input_path}' must be a directory")
 
-    # Collect audio files from input directory
-    filenames = []
-    dir_list = os.listdir(input_path)
-    for file in dir_list:
-        if file.lower().endswith((".mp3", ".flac")):
-            filenames.append(os.path.join(input_path, file))
+    # The input is walked recursively, so the landing zone can't be inside it
+    absolute_input = os.path.abspath(input_path)
+    absolute_output = os.path.abspath(output_path)
+    if os.path.commonpath([absolute_input, absolute_output]) == absolute_input:
+        raise ValueError(f"Output path '{output_path}' can't be inside '{input_path}'")
 
-    print("About to process the following files:")
-    for filename in filenames:
-        print(filename)
+    if incremental and retag_while_copying:
+        raise ValueError("Incremental syncing needs the separate copy step")
 
-    # Clear the landing zone
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path)
-    os.makedirs(output_path)
-
-    # Copy files to output location
-    for filename in filenames:
-        output_filename = os.path.join(output_path, os.path.basename(filename))
-        shutil.copy2(filename, output_filename)
+    print("About to process the following files:")
+    for entry in iter_audio_files(input_path, include=include, exclude=exclude):
+        print(entry.path)
+
+    if dry_run:
+        # Plan straight from the input, so the landing zone is left as it is
+        os.makedirs(output_path, exist_ok=True)
+        process_dir(
+            output_path,
+            source_dir=input_path,
+            skip_duplicates=skip_duplicates,
+            scan_workers=scan_workers,
+            scan_with_processes=scan_with_processes,
+            include=include,
+            exclude=exclude,
+            dry_run=True,
+            plan_path=plan_path,
+            auto_select=auto_select,
+            shrink_art=shrink_art,
+        )
+        return
+
+    if incremental:
+        os.makedirs(output_path, exist_ok=True)
+        manifest = sync_landing_zone(input_path, output_path, include, exclude)
+        if no_processing:
+            return
+
+        written_paths = process_dir(
+            output_path,
+            atomic=atomic,
+            skip_duplicates=skip_duplicates,
+            scan_workers=scan_workers,
+            scan_with_processes=scan_with_processes,
+            skip_processed=True,
+            auto_select=auto_select,
+            shrink_art=shrink_art,
+        )
+        # Remember where the renamed copies went, so they can be removed later
+        for manifest_entry in manifest.values():
+            copy_path = os.path.join(absolute_output, manifest_entry["output"])
+            if copy_path in written_paths:
+                new_path = written_paths[copy_path]
+                manifest_entry["output"] = os.path.relpath(new_path, absolute_output)
+        with open(os.path.join(output_path, MANIFEST_FILENAME), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return
+
+    # A journal means the last run crashed partway, so its landing zone is
+    # picked up where it stopped instead of being cleared
+    is_resuming = os.path.exists(os.path.join(output_path, JOURNAL_FILENAME))
+    if is_resuming:
+        print(f"Resuming the unfinished run in {output_path}")
+    else:
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path)
+        os.makedirs(output_path)
+
+    if retag_while_copying and not no_processing:
+        # process_dir writes each file into the landing zone with its new tags
+        process_dir(
+            output_path,
+            source_dir=input_path,
+            atomic=atomic,
+            skip_duplicates=skip_duplicates,
+            scan_workers=scan_workers,
+            scan_with_processes=scan_with_processes,
+            include=include,
+            exclude=exclude,
+            auto_select=auto_select,
+            shrink_art=shrink_art,
+        )
+        return
+
+    # Copy files to output location, keeping the folder structure
+    if not is_resuming:
+        copies = []
+        for entry in iter_audio_files(input_path, include=include, exclude=exclude):
+            relative_path = os.path.relpath(entry.path, input_path)
+            output_filename = os.path.join(output_path, relative_path)
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+            copies.append((entry.path, output_filename))
+        copy_files(copies)
 
     if not no_processing:
-        process_dir(output_path)
+        process_dir(
+            output_path,
+            atomic=atomic,
+            skip_duplicates=skip_duplicates,
+            scan_workers=scan_workers,
+            scan_with_processes=scan_with_processes,
+            auto_select=auto_select,
+            shrink_art=shrink_art,
+        )
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Please specify input file/folder and output file/folder.")
-        print("Usage: python soundscrape.py <input> <output>")
-        sys.exit(1)
-
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
-    main(input_path, output_path)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", nargs="?", help="Folder containing the audio files")
+    parser.add_argument(
+        "output",
+        nargs="?",
+        help="Landing zone folder, cleared before use unless --incremental or an earlier run crashed",
+    )
+    parser.add_argument(
+        "--retag-while-copying",
+        help="Write each file to the landing zone once, with its new tags, instead of copying it and then retagging it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--remote-storage",
+        help="Read tags with a few large reads instead of memory mapping, for music on a network share",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shrink-art",
+        help="Scale the chosen art down and re-encode it as a small JPEG before embedding it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--atomic",
+        help="Write every track to a temp file and move it into place, so a crash can't corrupt it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep-duplicates",
+        help="Process tracks even when the same recording was already seen",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--scan-workers",
+        help="How many files to read tags from at once",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--scan-threads",
+        help="Read tags on threads instead of processes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--include",
+        help='Only process files matching this glob, relative to the input folder, like "Artist/*". Can be repeated',
+        action="append",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="Skip files and folders matching this glob. Can be repeated",
+        action="append",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Keep the landing zone and only copy and process files that are new or changed since the last run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dry-run",
+        help="Pick the art and save a plan of every rename and tag change, without writing anything",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan", help="Where --dry-run saves the plan, instead of the landing zone"
+    )
+    parser.add_argument(
+        "--apply", help="Carry out a plan saved by --dry-run, instead of processing"
+    )
+    parser.add_argument(
+        "--auto-select",
+        help=f"Pick the art without asking, and list the albums it isn't sure about in {REVIEW_FILENAME}",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    file_metadata.REMOTE_STORAGE = args.remote_storage
+    if args.apply is not None:
+        with open(args.apply) as f:
+            plan = json.load(f)
+        written_paths = apply_plan(plan)
+        print(f"Wrote {len(written_paths)} files.")
+        sys.exit(0)
+    if args.input is None or args.output is None:
+        parser.error("input and output are required unless --apply is given")
+
+    main(
+        args.input,
+        args.output,
+        retag_while_copying=args.retag_while_copying,
+        atomic=args.atomic,
+        skip_duplicates=not args.keep_duplicates,
+        scan_workers=args.scan_workers,
+        scan_with_processes=not args.scan_threads,
+        include=args.include,
+        exclude=args.exclude,
+        incremental=args.incremental,
+        dry_run=args.dry_run,
+        plan_path=args.plan,
+        auto_select=args.auto_select,
+        shrink_art=args.shrink_art,
+    )
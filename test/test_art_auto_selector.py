@@ -0,0 +1,61 @@
+from io import BytesIO
+from unittest import TestCase
+
+from PIL import Image
+
+from art_auto_selector import auto_select_art
+
+
+def read_image(name: str) -> bytes:
+    with open(f"test/images/{name}", "rb") as f:
+        return f.read()
+
+
+class AutoSelectArtTests(TestCase):
+    def test_picks_best_copy_of_most_common_cover(self):
+        choices = [
+            read_image("2.png"),
+            read_image("1_low_res_300x300.png"),
+            read_image("1.png"),
+            read_image("1_very_lossy.png"),
+        ]
+        sources = ["spotify", "embedded", "embedded", "musicbrainz"]
+        self.assertEqual(auto_select_art(choices, sources), (2, True))
+
+    def test_prefers_higher_resolution_copy(self):
+        choices = [
+            read_image("1_cropped_non_square.png"),
+            read_image("1_low_res_300x300.png"),
+        ]
+        index, is_confident = auto_select_art(choices, ["embedded", "spotify"])
+        self.assertEqual(index, 0)
+        self.assertTrue(is_confident)
+
+    def test_prefers_square_copy_of_same_resolution(self):
+        square = read_image("1_low_res_300x300.png")
+        stretched = BytesIO()
+        Image.open(BytesIO(square)).resize((300, 330)).save(stretched, format="PNG")
+        choices = [stretched.getvalue(), square]
+        index, is_confident = auto_select_art(choices, ["embedded", "spotify"])
+        self.assertEqual(index, 1)
+        self.assertTrue(is_confident)
+
+    def test_single_source_is_not_confident(self):
+        self.assertEqual(
+            auto_select_art([read_image("1.png")], ["embedded"]), (0, False)
+        )
+
+    def test_copies_from_one_source_are_not_confident(self):
+        choices = [
+            read_image("1.png"),
+            read_image("1_very_lossy.png"),
+            read_image("2.png"),
+        ]
+        sources = ["embedded", "embedded", "spotify"]
+        index, is_confident = auto_select_art(choices, sources)
+        self.assertFalse(is_confident)
+
+    def test_tie_between_covers_is_not_confident(self):
+        choices = [read_image("1.png"), read_image("2.png")]
+        index, is_confident = auto_select_art(choices, ["embedded", "spotify"])
+        self.assertFalse(is_confident)
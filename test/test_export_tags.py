@@ -0,0 +1,62 @@
+import hashlib
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from export_tags import export_library, export_track
+from file_metadata import get_cover_art, read_tags
+
+
+class ExportTagsTests(TestCase):
+    def setUp(self):
+        self.library_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.library_dir, "Artist"))
+        shutil.copy2("test/yeet.mp3", os.path.join(self.library_dir, "a.mp3"))
+        shutil.copy2(
+            "test/yeet.flac", os.path.join(self.library_dir, "Artist", "b.flac")
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.library_dir)
+
+    def test_export_track(self):
+        record = export_track("test/yeet.mp3")
+        tags = read_tags("test/yeet.mp3")
+        self.assertEqual(record["title"], tags.title)
+        self.assertEqual(record["artist"], tags.artist)
+        self.assertGreater(record["duration"], 0)
+        self.assertGreater(record["bitrate"], 0)
+        expected_digest = hashlib.sha256(get_cover_art("test/yeet.mp3")).hexdigest()
+        self.assertEqual(record["art_digest"], expected_digest)
+        self.assertGreater(record["art_width"], 0)
+        self.assertGreater(record["art_height"], 0)
+
+    def test_export_library(self):
+        output = StringIO()
+        self.assertEqual(export_library(self.library_dir, output, workers=2), 2)
+
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        paths = [record["path"] for record in records]
+        self.assertEqual(
+            sorted(paths),
+            [
+                os.path.join(self.library_dir, "Artist", "b.flac"),
+                os.path.join(self.library_dir, "a.mp3"),
+            ],
+        )
+
+    def test_export_library_reports_unreadable_files(self):
+        broken_path = os.path.join(self.library_dir, "broken.mp3")
+        with open(broken_path, "wb") as f:
+            f.write(os.urandom(4096))
+
+        output = StringIO()
+        self.assertEqual(export_library(self.library_dir, output, workers=2), 3)
+
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        errors = [record for record in records if "error" in record]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["path"], broken_path)
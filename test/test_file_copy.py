@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import file_copy
+from file_copy import copy_file, copy_files, file_sha256
+
+
+class FileCopyTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_copy_file(self):
+        destination = os.path.join(self.temp_dir, "copy.flac")
+        method = copy_file("test/yeet.flac", destination)
+
+        self.assertIn(method, ["reflink", "copy_file_range", "buffered"])
+        self.assertEqual(file_sha256(destination), file_sha256("test/yeet.flac"))
+        self.assertEqual(
+            os.stat(destination).st_mtime_ns, os.stat("test/yeet.flac").st_mtime_ns
+        )
+
+    def test_copy_file_reads_source_once(self):
+        destination = os.path.join(self.temp_dir, "copy.flac")
+        hashed = []
+
+        def recording_sha256(filename):
+            hashed.append(filename)
+            return file_sha256(filename)
+
+        with patch("file_copy.file_sha256", recording_sha256):
+            method = copy_file("test/yeet.flac", destination)
+
+        # The source is hashed while it's copied, only the copy is read again
+        if method == "reflink":
+            self.assertEqual(hashed, [])
+        else:
+            self.assertEqual(method, "buffered")
+            self.assertEqual(hashed, [destination])
+
+    def test_copy_file_catches_bad_copy(self):
+        destination = os.path.join(self.temp_dir, "copy.flac")
+
+        def wrong_sha256(filename):
+            return "0" * 64
+
+        try:
+            with patch("file_copy.file_sha256", wrong_sha256):
+                method = copy_file("test/yeet.flac", destination)
+            self.assertEqual(method, "reflink")
+        except file_copy.CopyVerificationError:
+            self.assertFalse(os.path.exists(destination))
+
+    def test_copy_file_checks_given_digest(self):
+        destination = os.path.join(self.temp_dir, "copy.flac")
+        try:
+            method = copy_file("test/yeet.flac", destination, source_digest="0" * 64)
+            self.assertEqual(method, "reflink")
+        except file_copy.CopyVerificationError:
+            self.assertFalse(os.path.exists(destination))
+
+        method = copy_file(
+            "test/yeet.flac", destination, source_digest=file_sha256("test/yeet.flac")
+        )
+        if hasattr(os, "copy_file_range"):
+            self.assertNotEqual(method, "buffered")
+
+    def test_copy_files(self):
+        copies = []
+        for name in ["a.mp3", "b.mp3", "c.flac"]:
+            source = "test/yeet." + name.split(".")[1]
+            copies.append((source, os.path.join(self.temp_dir, name)))
+
+        counts = copy_files(copies, workers=2)
+        self.assertEqual(sum(counts.values()), 3)
+        for source, destination in copies:
+            self.assertEqual(file_sha256(destination), file_sha256(source))
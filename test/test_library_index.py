@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from mutagen.flac import FLAC
+
+import file_metadata
+from file_metadata import art_digest, audio_digest, read_tags, set_song_title
+from library_index import TAG_COLUMNS, LibraryIndex, iter_audio_files, read_track
+
+
+class LibraryIndexTests(TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.library_dir = os.path.join(self.test_dir, "library")
+        os.makedirs(os.path.join(self.library_dir, "Artist", "Album"))
+        shutil.copy2("test/yeet.mp3", os.path.join(self.library_dir, "song1.mp3"))
+        shutil.copy2("test/yeet.flac", os.path.join(self.library_dir, "song2.flac"))
+        shutil.copy2(
+            "test/yeet.mp3",
+            os.path.join(self.library_dir, "Artist", "Album", "song3.mp3"),
+        )
+
+        self.index = LibraryIndex(os.path.join(self.test_dir, "index.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_scan_reads_every_file(self):
+        self.assertEqual(self.index.scan(self.library_dir), 3)
+
+    def test_scan_reads_full_date_flac(self):
+        song2 = os.path.join(self.library_dir, "song2.flac")
+        audiofile = FLAC(song2)
+        audiofile["DATE"] = ["2020-01-02"]
+        audiofile.save()
+
+        self.index.scan(self.library_dir)
+        for track in self.index.tracks_in(self.library_dir):
+            if track.path == song2:
+                self.assertEqual(track.tags.year, 2020)
+        self.assertEqual(read_tags(song2).year, 2020)
+
+    def test_read_track_reads_tag_once_remote_storage(self):
+        heads_read = []
+        original_read_head = file_metadata._read_head
+
+        def counting_read_head(f):
+            heads_read.append(f.name)
+            return original_read_head(f)
+
+        song1 = os.path.join(self.library_dir, "song1.mp3")
+        # Earlier tests can leave a cached art digest for a file on this inode
+        file_metadata._art_digest_cache.clear()
+        file_metadata.REMOTE_STORAGE = True
+        try:
+            with patch("file_metadata._read_head", counting_read_head):
+                row = read_track(song1)
+        finally:
+            file_metadata.REMOTE_STORAGE = False
+        self.assertEqual(heads_read, [song1])
+        self.assertEqual(row[10], art_digest(song1))
+
+    def test_iter_audio_files(self):
+        def walk(**kwargs):
+            paths = []
+            for entry in iter_audio_files(self.library_dir, **kwargs):
+                paths.append(os.path.relpath(entry.path, self.library_dir))
+            return sorted(paths)
+
+        song3 = os.path.join("Artist", "Album", "song3.mp3")
+        self.assertEqual(walk(), [song3, "song1.mp3", "song2.flac"])
+        self.assertEqual(walk(recursive=False), ["song1.mp3", "song2.flac"])
+        self.assertEqual(walk(include=["*.mp3"]), [song3, "song1.mp3"])
+        self.assertEqual(walk(exclude=["Artist"]), ["song1.mp3", "song2.flac"])
+
+    def test_iter_audio_files_skips_folder_links(self):
+        os.symlink("..", os.path.join(self.library_dir, "Artist", "loop"))
+        paths = []
+        for entry in iter_audio_files(self.library_dir):
+            paths.append(os.path.relpath(entry.path, self.library_dir))
+        self.assertEqual(len(paths), 3)
+
+    def test_scan_with_exclude(self):
+        self.assertEqual(self.index.scan(self.library_dir, exclude=["*.flac"]), 2)
+
+    def test_tracks_in_recursive(self):
+        self.index.scan(self.library_dir)
+        self.assertEqual(len(self.index.tracks_in(self.library_dir)), 2)
+        self.assertEqual(len(self.index.tracks_in(self.library_dir, recursive=True)), 3)
+
+    def test_scan_on_worker_processes(self):
+        self.assertEqual(self.index.scan(self.library_dir, 2, use_processes=True), 3)
+        for track in self.index.tracks_in(self.library_dir):
+            self.assertEqual(track.tags, read_tags(track.path, TAG_COLUMNS))
+            self.assertEqual(track.art_digest, art_digest(track.path))
+
+    def test_rescan_skips_unchanged_files(self):
+        self.index.scan(self.library_dir)
+        self.assertEqual(self.index.scan(self.library_dir), 0)
+
+    def test_rescan_reads_changed_files(self):
+        self.index.scan(self.library_dir)
+        song1 = os.path.join(self.library_dir, "song1.mp3")
+        set_song_title(song1, "Changed Title")
+
+        self.assertEqual(self.index.scan(self.library_dir), 1)
+        titles = []
+        for track in self.index.tracks_in(self.library_dir):
+            titles.append(track.tags.title)
+        self.assertIn("Changed Title", titles)
+
+    def test_rescan_removes_deleted_files(self):
+        self.index.scan(self.library_dir)
+        os.remove(os.path.join(self.library_dir, "song1.mp3"))
+        self.index.scan(self.library_dir)
+
+        self.assertEqual(len(self.index.tracks_in(self.library_dir)), 1)
+
+    def test_tracks_in_matches_file_tags(self):
+        self.index.scan(self.library_dir)
+        tracks = self.index.tracks_in(self.library_dir)
+
+        self.assertEqual(len(tracks), 2)
+        for track in tracks:
+            expected_tags = read_tags(track.path)
+            expected_tags.cover_art = None
+            self.assertEqual(track.tags, expected_tags)
+            self.assertEqual(track.art_digest, art_digest(track.path))
+            self.assertFalse(track.processed)
+
+    def test_record_processed(self):
+        self.index.scan(self.library_dir)
+        song1 = os.path.join(self.library_dir, "song1.mp3")
+        self.index.record(song1, processed=True)
+
+        for track in self.index.tracks_in(self.library_dir):
+            self.assertEqual(track.processed, track.path == os.path.abspath(song1))
+
+    def test_paths_with_audio_ignores_tag_differences(self):
+        song1 = os.path.join(self.library_dir, "song1.mp3")
+        song3 = os.path.join(self.library_dir, "Artist", "Album", "song3.mp3")
+        set_song_title(song3, "Different Title")
+        self.index.scan(self.library_dir)
+
+        self.assertEqual(
+            self.index.paths_with_audio(audio_digest(song1)), [song3, song1]
+        )
@@ -1,9 +1,22 @@
+import hashlib
+from io import BytesIO
 import os
 import shutil
+import tempfile
 from unittest import TestCase
 
+from mutagen.flac import FLAC
+from mutagen.id3 import ID3
+from PIL import Image
+
+import file_metadata
 from file_metadata import (
+    AtomicWriteBatch,
     NoTagError,
+    TagTransaction,
+    apply_tags,
+    art_digest,
+    audio_digest,
     clear_album_artist,
     clear_album_title,
     clear_artist,
@@ -11,13 +24,19 @@ from file_metadata import (
     clear_lyrics,
     clear_song_title,
     clear_year,
+    copy_with_tags,
     get_album_artist,
     get_album_title,
     get_artist,
     get_cover_art,
+    get_cover_art_handle,
     get_lyrics,
     get_song_title,
     get_year,
+    normalize_art,
+    read_tags,
+    read_tags_fast,
+    recover_atomic_writes,
     set_album_artist,
     set_album_title,
     set_artist,
@@ -25,6 +44,7 @@ from file_metadata import (
     set_lyrics,
     set_song_title,
     set_year,
+    sync_tags,
 )
 
 
@@ -36,12 +56,240 @@ class TestReadMetadata(TestCase):
         if os.path.exists("test/nolimit.flac"):
             shutil.copy2("test/nolimit.flac", self.NOLIMIT_FLAC_BACKUP)
 
+        # Scratch space for tests that shouldn't touch the shared fixtures
+        self.temp_dir = tempfile.mkdtemp()
+
     def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
         # Restore original nolimit.flac after each test
         if os.path.exists(self.NOLIMIT_FLAC_BACKUP):
             shutil.copy2(self.NOLIMIT_FLAC_BACKUP, "test/nolimit.flac")
             os.remove(self.NOLIMIT_FLAC_BACKUP)
 
+    def test_apply_tags(self):
+        files = []
+        for name in ["a.mp3", "b.mp3", "c.flac"]:
+            filename = os.path.join(self.temp_dir, name)
+            shutil.copy2("test/yeet." + name.split(".")[1], filename)
+            files.append(filename)
+        with open("test/beyond.jpg", "rb") as f:
+            image_data = f.read()
+
+        file_updates = {files[0]: {"title": "First"}, files[2]: {"title": "Third"}}
+        apply_tags(
+            files,
+            {"album": "Shared Album", "year": None, "cover_art": image_data},
+            workers=2,
+            file_updates=file_updates,
+        )
+
+        for filename in files:
+            tags = read_tags(filename)
+            self.assertEqual(tags.album, "Shared Album")
+            self.assertIsNone(tags.year)
+            self.assertEqual(tags.cover_art, image_data)
+        self.assertEqual(get_song_title(files[0]), "First")
+        self.assertEqual(get_song_title(files[1]), get_song_title("test/yeet.mp3"))
+        self.assertEqual(get_song_title(files[2]), "Third")
+
+    def test_apply_tags_skips_files_already_in_sync(self):
+        files = []
+        for name in ["a.mp3", "b.flac"]:
+            filename = os.path.join(self.temp_dir, name)
+            shutil.copy2("test/yeet." + name.split(".")[1], filename)
+            files.append(filename)
+        with open("test/beyond.jpg", "rb") as f:
+            image_data = f.read()
+        updates = {"album": "Shared Album", "cover_art": image_data}
+
+        first_counts = apply_tags(files, updates)
+        self.assertEqual(first_counts["unchanged"], 0)
+        modification_times = [os.stat(filename).st_mtime_ns for filename in files]
+
+        second_counts = apply_tags(files, updates)
+        self.assertEqual(second_counts["unchanged"], 2)
+        for filename, modification_time in zip(files, modification_times):
+            self.assertEqual(os.stat(filename).st_mtime_ns, modification_time)
+
+    def test_sync_tags(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        current_title = get_song_title(filename)
+
+        self.assertEqual(sync_tags(filename, {"title": current_title}), "unchanged")
+        self.assertEqual(sync_tags(filename, {"title": "New"}), "updated")
+        self.assertEqual(get_song_title(filename), "New")
+        self.assertEqual(sync_tags(filename, {"album": None}), "updated")
+        self.assertEqual(sync_tags(filename, {"album": None}), "unchanged")
+
+    def test_copy_with_tags(self):
+        with open("test/beyond.jpg", "rb") as f:
+            image_data = f.read()
+
+        for extension in ["mp3", "flac"]:
+            source = "test/yeet." + extension
+            destination = os.path.join(self.temp_dir, "copy." + extension)
+            desired = {"title": "Copied", "year": None, "cover_art": image_data}
+            copy_with_tags(source, destination, desired)
+
+            tags = read_tags(destination)
+            self.assertEqual(tags.title, "Copied")
+            self.assertIsNone(tags.year)
+            self.assertEqual(tags.album, get_album_title(source))
+            self.assertEqual(tags.cover_art, image_data)
+            self.assertEqual(sync_tags(destination, desired), "unchanged")
+
+    def test_atomic_write_batch(self):
+        first = os.path.join(self.temp_dir, "first.txt")
+        second = os.path.join(self.temp_dir, "second.txt")
+        with open(first, "w") as f:
+            f.write("old")
+
+        with AtomicWriteBatch(group_size=2) as batch:
+            batch.write(first, b"new")
+            with open(first) as f:
+                self.assertEqual(f.read(), "old")
+            batch.write(second, b"second")
+            with open(first) as f:
+                self.assertEqual(f.read(), "new")
+        with open(second) as f:
+            self.assertEqual(f.read(), "second")
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ["first.txt", "second.txt"])
+
+    def test_atomic_write_batch_keeps_mode(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        os.chmod(filename, 0o640)
+        copy = os.path.join(self.temp_dir, "copy.mp3")
+
+        with AtomicWriteBatch() as batch:
+            sync_tags(filename, {"title": "New"}, batch)
+            copy_with_tags(filename, copy, {"title": "Copied"}, batch)
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(copy).st_mode & 0o777, 0o640)
+
+        other_copy = os.path.join(self.temp_dir, "other_copy.mp3")
+        copy_with_tags(filename, other_copy, {"title": "Copied"})
+        self.assertEqual(os.stat(other_copy).st_mode & 0o777, 0o640)
+
+    def test_atomic_write_batch_discards_on_error(self):
+        filename = os.path.join(self.temp_dir, "file.txt")
+        with open(filename, "w") as f:
+            f.write("old")
+
+        with self.assertRaises(RuntimeError):
+            with AtomicWriteBatch() as batch:
+                batch.write(filename, b"new")
+                raise RuntimeError()
+        with open(filename) as f:
+            self.assertEqual(f.read(), "old")
+        self.assertEqual(os.listdir(self.temp_dir), ["file.txt"])
+
+    def test_recover_atomic_writes(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        batch = AtomicWriteBatch()
+        batch.write(filename, b"never replaced")
+
+        removed = recover_atomic_writes(self.temp_dir)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(os.listdir(self.temp_dir), ["yeet.mp3"])
+        self.assertEqual(read_tags(filename), read_tags("test/yeet.mp3"))
+
+    def test_apply_tags_atomic(self):
+        files = []
+        for name in ["a.mp3", "b.flac"]:
+            filename = os.path.join(self.temp_dir, name)
+            shutil.copy2("test/yeet." + name.split(".")[1], filename)
+            files.append(filename)
+
+        counts = apply_tags(files, {"album": "Atomic Album"}, atomic=True)
+        self.assertEqual(counts["rewritten"], 2)
+        for filename in files:
+            self.assertEqual(get_album_title(filename), "Atomic Album")
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ["a.mp3", "b.flac"])
+
+    def test_apply_tags_atomic_failure_changes_nothing(self):
+        filename = os.path.join(self.temp_dir, "a.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        missing = os.path.join(self.temp_dir, "missing.mp3")
+
+        with self.assertRaises(FileNotFoundError):
+            apply_tags([filename, missing], {"album": "Atomic Album"}, atomic=True)
+        self.assertEqual(get_album_title(filename), get_album_title("test/yeet.mp3"))
+        self.assertEqual(os.listdir(self.temp_dir), ["a.mp3"])
+
+    def test_audio_digest_ignores_tags(self):
+        for extension in ["mp3", "flac"]:
+            filename = os.path.join(self.temp_dir, "yeet." + extension)
+            shutil.copy2("test/yeet." + extension, filename)
+            original_digest = audio_digest(filename)
+
+            with TagTransaction(filename, padding=0) as transaction:
+                transaction.set("lyrics", "la " * 5000)
+                transaction.clear("cover_art")
+            self.assertEqual(audio_digest(filename), original_digest)
+
+    def test_audio_digest_skips_id3v1(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        original_digest = audio_digest(filename)
+
+        ID3(filename).save(v1=2)
+        with open(filename, "rb") as f:
+            f.seek(-128, os.SEEK_END)
+            self.assertEqual(f.read(3), b"TAG")
+        self.assertEqual(audio_digest(filename), original_digest)
+
+    def test_normalize_art_shrinks_large_png(self):
+        with open("test/images/1.png", "rb") as f:
+            image_data = f.read()
+
+        normalized = normalize_art(image_data, max_edge=500, max_bytes=100 * 1024)
+        image = Image.open(BytesIO(normalized))
+        self.assertEqual(image.format, "JPEG")
+        self.assertEqual(image.size, (500, 500))
+        self.assertLessEqual(len(normalized), 100 * 1024)
+        self.assertNotIn("exif", image.info)
+        self.assertNotIn("icc_profile", image.info)
+
+    def test_normalize_art_keeps_small_jpeg(self):
+        with open("test/image.jpg", "rb") as f:
+            image_data = f.read()
+
+        self.assertEqual(normalize_art(image_data), image_data)
+
+    def test_normalize_art_applies_orientation(self):
+        exif = Image.Exif()
+        # Rotated 90 degrees
+        exif[0x0112] = 6
+        output = BytesIO()
+        Image.new("RGB", (300, 200)).save(output, format="JPEG", exif=exif.tobytes())
+
+        normalized = normalize_art(output.getvalue())
+        self.assertEqual(Image.open(BytesIO(normalized)).size, (200, 300))
+
+    def test_set_cover_art_labels_webp(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        output = BytesIO()
+        Image.new("RGB", (100, 100)).save(output, format="WEBP")
+
+        clear_cover_art(filename)
+        set_cover_art(filename, output.getvalue())
+        self.assertEqual(get_cover_art_handle(filename).mime, "image/webp")
+
+    def test_set_cover_art_labels_png(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        with open("test/images/1.png", "rb") as f:
+            image_data = f.read()
+
+        clear_cover_art(filename)
+        set_cover_art(filename, image_data)
+        self.assertEqual(get_cover_art_handle(filename).mime, "image/png")
+
     # MP3 Tests
     def test_get_year_mp3(self):
         year = get_year("test/yeet.mp3")
@@ -191,6 +439,160 @@ class TestReadMetadata(TestCase):
             image_data = f.read()
         set_cover_art("test/yeet.mp3", image_data)
 
+    def test_read_tags_mp3(self):
+        set_song_title("test/yeet.mp3", "Test Song")
+        set_artist("test/yeet.mp3", "Test Artist")
+        tags = read_tags("test/yeet.mp3")
+        self.assertEqual(tags.title, "Test Song")
+        self.assertEqual(tags.artist, "Test Artist")
+        self.assertEqual(tags.year, get_year("test/yeet.mp3"))
+        self.assertEqual(tags.album, get_album_title("test/yeet.mp3"))
+        self.assertEqual(tags.cover_art, get_cover_art("test/yeet.mp3"))
+
+    def test_read_tags_only_requested_fields_mp3(self):
+        tags = read_tags("test/yeet.mp3", ["artist"])
+        self.assertEqual(tags.artist, get_artist("test/yeet.mp3"))
+        self.assertIsNone(tags.title)
+        self.assertIsNone(tags.cover_art)
+
+    def test_read_tags_missing_field_mp3(self):
+        clear_album_title("test/yeet.mp3")
+        tags = read_tags("test/yeet.mp3")
+        self.assertIsNone(tags.album)
+        set_album_title("test/yeet.mp3", "Test Album")
+
+    def test_read_tags_unknown_field(self):
+        with self.assertRaises(ValueError):
+            read_tags("test/yeet.mp3", ["genre"])
+
+    def test_tag_transaction_mp3(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+
+        with TagTransaction(filename) as transaction:
+            transaction.set("title", "Transaction Song")
+            transaction.set("artist", "Transaction Artist")
+            transaction.clear("album")
+        self.assertEqual(get_song_title(filename), "Transaction Song")
+        self.assertEqual(get_artist(filename), "Transaction Artist")
+        with self.assertRaises(NoTagError):
+            get_album_title(filename)
+
+    def test_tag_transaction_reports_rewrite_mp3(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        with open("test/beyond.jpg", "rb") as f:
+            image_data = f.read()
+
+        with TagTransaction(filename, padding=len(image_data)) as transaction:
+            transaction.set("cover_art", image_data)
+        self.assertTrue(transaction.rewrote_file)
+        size_after_growing = os.path.getsize(filename)
+
+        # The second picture fits in the padding left by the first save
+        with TagTransaction(filename) as transaction:
+            transaction.set("lyrics", "Some new lyrics")
+            transaction.set("cover_art", image_data[:-1000])
+        self.assertFalse(transaction.rewrote_file)
+        self.assertEqual(os.path.getsize(filename), size_after_growing)
+
+    def test_tag_transaction_gives_back_padding(self):
+        noise = Image.frombytes("RGB", (1000, 1000), os.urandom(3 * 1000 * 1000))
+        output = BytesIO()
+        noise.save(output, format="PNG")
+        large_art = output.getvalue()
+        with open("test/beyond.jpg", "rb") as f:
+            small_art = f.read()
+
+        for extension in ["mp3", "flac"]:
+            filename = os.path.join(self.temp_dir, f"yeet.{extension}")
+            shutil.copy2(f"test/yeet.{extension}", filename)
+            size_without_art = os.path.getsize(filename)
+            set_cover_art(filename, large_art)
+
+            with TagTransaction(filename) as transaction:
+                transaction.replace("cover_art", small_art)
+            self.assertTrue(transaction.rewrote_file)
+            self.assertLess(
+                os.path.getsize(filename),
+                size_without_art + len(small_art) + file_metadata.TAG_MAX_PADDING,
+            )
+            self.assertEqual(get_cover_art(filename), small_art)
+
+    def test_tag_transaction_not_saved_on_error_mp3(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        original_title = get_song_title(filename)
+
+        with self.assertRaises(RuntimeError):
+            with TagTransaction(filename) as transaction:
+                transaction.set("title", "Never Saved")
+                raise RuntimeError()
+        self.assertEqual(get_song_title(filename), original_title)
+
+    def test_read_tags_fast_mp3(self):
+        self.assertEqual(read_tags_fast("test/yeet.mp3"), read_tags("test/yeet.mp3"))
+
+    def test_read_tags_fast_id3v23_mp3(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        id3 = ID3(filename)
+        id3.save(v2_version=3)
+
+        self.assertEqual(read_tags_fast(filename), read_tags(filename))
+
+    def test_read_tags_fast_remote_storage_mp3(self):
+        file_metadata.REMOTE_STORAGE = True
+        try:
+            self.assertEqual(
+                read_tags_fast("test/yeet.mp3"), read_tags("test/yeet.mp3")
+            )
+            self.assertEqual(
+                art_digest("test/yeet.mp3"),
+                hashlib.sha256(get_cover_art("test/yeet.mp3")).digest(),
+            )
+        finally:
+            file_metadata.REMOTE_STORAGE = False
+
+    def test_read_tags_fast_falls_back_without_id3v2_mp3(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        id3 = ID3(filename)
+        id3.delete(filename, delete_v1=False)
+
+        self.assertEqual(read_tags_fast(filename), read_tags(filename))
+
+    def test_get_cover_art_handle_mp3(self):
+        handle = get_cover_art_handle("test/yeet.mp3")
+        self.assertEqual(handle.mime, "image/jpeg")
+        self.assertEqual(handle.read(), get_cover_art("test/yeet.mp3"))
+        self.assertEqual(handle.length, len(get_cover_art("test/yeet.mp3")))
+
+    def test_get_cover_art_handle_falls_back_to_mutagen(self):
+        filename = os.path.join(self.temp_dir, "yeet.audio")
+        shutil.copy2("test/yeet.mp3", filename)
+
+        handle = get_cover_art_handle(filename)
+        self.assertIsNone(handle.offset)
+        self.assertEqual(handle.read(), get_cover_art(filename))
+
+    def test_art_digest_mp3(self):
+        expected = hashlib.sha256(get_cover_art("test/yeet.mp3")).digest()
+        self.assertEqual(art_digest("test/yeet.mp3"), expected)
+
+    def test_art_digest_changes_with_file_mp3(self):
+        filename = os.path.join(self.temp_dir, "yeet.mp3")
+        shutil.copy2("test/yeet.mp3", filename)
+        first_digest = art_digest(filename)
+
+        with open("test/beyond.jpg", "rb") as f:
+            image_data = f.read()
+        clear_cover_art(filename)
+        set_cover_art(filename, image_data)
+
+        self.assertNotEqual(art_digest(filename), first_digest)
+        self.assertEqual(art_digest(filename), hashlib.sha256(image_data).digest())
+
     # FLAC Tests
     def test_get_year_flac(self):
         set_year("test/yeet.flac", 2025)
@@ -342,3 +744,59 @@ class TestReadMetadata(TestCase):
         with open("test/image.jpg", "rb") as f:
             image_data = f.read()
         set_cover_art("test/yeet.flac", image_data)
+
+    def test_read_tags_flac(self):
+        set_song_title("test/yeet.flac", "Test Song")
+        set_artist("test/yeet.flac", "Test Artist")
+        tags = read_tags("test/yeet.flac")
+        self.assertEqual(tags.title, "Test Song")
+        self.assertEqual(tags.artist, "Test Artist")
+        self.assertEqual(tags.year, get_year("test/yeet.flac"))
+        self.assertEqual(tags.album, get_album_title("test/yeet.flac"))
+        self.assertEqual(tags.lyrics, get_lyrics("test/yeet.flac"))
+        self.assertEqual(tags.cover_art, get_cover_art("test/yeet.flac"))
+
+    def test_tag_transaction_flac(self):
+        filename = os.path.join(self.temp_dir, "yeet.flac")
+        shutil.copy2("test/yeet.flac", filename)
+        with open("test/image.jpg", "rb") as f:
+            image_data = f.read()
+
+        with TagTransaction(filename) as transaction:
+            transaction.set("title", "Transaction Song")
+            transaction.clear("cover_art")
+            transaction.set("cover_art", image_data)
+        self.assertEqual(get_song_title(filename), "Transaction Song")
+        self.assertEqual(get_cover_art(filename), image_data)
+
+    def test_read_tags_fast_flac(self):
+        self.assertEqual(read_tags_fast("test/yeet.flac"), read_tags("test/yeet.flac"))
+
+    def test_read_tags_fast_empty_value_flac(self):
+        filename = os.path.join(self.temp_dir, "yeet.flac")
+        shutil.copy2("test/yeet.flac", filename)
+        audiofile = FLAC(filename)
+        audiofile["ALBUM"] = [""]
+        audiofile.save()
+        self.assertEqual(read_tags_fast(filename), read_tags(filename))
+
+    def test_read_tags_fast_remote_storage_flac(self):
+        # A tiny first read makes the metadata block walk read more of the file
+        file_metadata.REMOTE_STORAGE = True
+        file_metadata.HEAD_READ_SIZE = 16
+        try:
+            self.assertEqual(
+                read_tags_fast("test/yeet.flac"), read_tags("test/yeet.flac")
+            )
+        finally:
+            file_metadata.REMOTE_STORAGE = False
+            file_metadata.HEAD_READ_SIZE = 256 * 1024
+
+    def test_get_cover_art_handle_flac(self):
+        handle = get_cover_art_handle("test/yeet.flac")
+        self.assertEqual(handle.mime, "image/jpeg")
+        self.assertEqual(handle.read(), get_cover_art("test/yeet.flac"))
+
+    def test_art_digest_flac(self):
+        expected = hashlib.sha256(get_cover_art("test/yeet.flac")).digest()
+        self.assertEqual(art_digest("test/yeet.flac"), expected)
@@ -1,14 +1,135 @@
+from contextlib import redirect_stdout
+from io import StringIO
+import json
 import os
 import shutil
 import sys
 import tempfile
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
 
 # Add parent directory to path to import soundscrape
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from soundscrape import main
+from file_metadata import get_cover_art, normalize_art, set_album_title
+from library_index import INDEX_FILENAME
+from soundscrape import (
+    JOURNAL_FILENAME,
+    PLAN_FILENAME,
+    REVIEW_FILENAME,
+    SELECTORS_AHEAD,
+    JobJournal,
+    apply_plan,
+    main,
+    process_dir,
+)
+
+
+def fake_search_cover_art(artist, album, *args):
+    with open("test/beyond.jpg", "rb") as f:
+        return f.read()
+
+
+def search_failing_on_b(artist, album, *args):
+    """Stands in for an art search that crashes on album B."""
+    if album == "B":
+        raise RuntimeError("Search failed")
+    return fake_search_cover_art(artist, album)
+
+
+def search_agreeing_on_a(artist, album, *args):
+    """Stands in for an art search that finds album A's embedded art."""
+    if album == "A":
+        with open("test/image.jpg", "rb") as f:
+            return f.read()
+    return fake_search_cover_art(artist, album)
+
+
+class FirstChoiceSelector:
+    """Stands in for the art selection window, always picking the first image."""
+
+    def __init__(self, images):
+        self.images = images
+
+    def show_selection_window(self):
+        return 0
+
+
+class LastChoiceSelector(FirstChoiceSelector):
+    """Picks the last image, which is the searched art."""
+
+    def show_selection_window(self):
+        return len(self.images) - 1
+
+
+class NoWindowSelector(FirstChoiceSelector):
+    def show_selection_window(self):
+        raise AssertionError("The selection window was opened")
+
+
+class CountingSelector(FirstChoiceSelector):
+    """Keeps track of how many selectors were alive at the same time."""
+
+    alive = 0
+    most_alive = 0
+
+    def __init__(self, images):
+        super().__init__(images)
+        CountingSelector.alive += 1
+        CountingSelector.most_alive = max(
+            CountingSelector.most_alive, CountingSelector.alive
+        )
+
+    def __del__(self):
+        CountingSelector.alive -= 1
+
+
+first_selector_built = threading.Event()
+# Whether album B's search saw the selector being built, or gave up waiting
+b_search_saw_selector = []
+
+
+def search_waiting_on_first_selector(artist, album, *args):
+    """Stands in for a slow search of album B that only ends once A's selector exists."""
+    if album == "B":
+        b_search_saw_selector.append(first_selector_built.wait(timeout=5))
+    return fake_search_cover_art(artist, album)
+
+
+class SignallingSelector(FirstChoiceSelector):
+    def __init__(self, images):
+        super().__init__(images)
+        first_selector_built.set()
+
+
+class OverlapCountingSearch:
+    """Stands in for a slow art search, counting how many ran at once."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def __call__(self, artist, album, *args):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.2)
+        with self.lock:
+            self.running -= 1
+        return fake_search_cover_art(artist, album)
+
+
+def audio_files_in(directory):
+    found = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith((".mp3", ".flac")):
+                found.append(os.path.relpath(os.path.join(root, filename), directory))
+    return sorted(found)
 
 
 class SoundScrapeFileIOTests(TestCase):
@@ -30,6 +151,20 @@ class SoundScrapeFileIOTests(TestCase):
         shutil.copy2("test/yeet.mp3", os.path.join(self.test_input_dir, "song1.mp3"))
         shutil.copy2("test/yeet.mp3", os.path.join(self.test_input_dir, "song2.flac"))
 
+    def make_albums(self):
+        """Album A has two tracks, album B one that is the same recording as A's first."""
+        albums_dir = os.path.join(self.test_dir, "albums")
+        for relative_path, fixture, album in [
+            ("A/t0.mp3", "test/yeet.mp3", "A"),
+            ("A/t1.flac", "test/yeet.flac", "A"),
+            ("B/t2.mp3", "test/yeet.mp3", "B"),
+        ]:
+            path = os.path.join(albums_dir, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copy2(fixture, path)
+            set_album_title(path, album)
+        return albums_dir
+
     def tearDown(self):
         # Clean up temporary directory
         shutil.rmtree(self.test_dir)
@@ -90,3 +225,243 @@ class SoundScrapeFileIOTests(TestCase):
             main(self.test_input_file, output_dir, no_processing=True)
 
         self.assertFalse(os.path.exists(output_dir))
+
+    def test_incremental_copies_only_new_files(self):
+        """Test incremental mode: a second run copies only the added file"""
+        output_dir = os.path.join(self.test_dir, "output")
+        main(self.test_input_dir, output_dir, no_processing=True, incremental=True)
+
+        # copy2 would put the source's mtime back if song1 were copied again
+        song1_copy = os.path.join(output_dir, "song1.mp3")
+        os.utime(song1_copy, ns=(1, 1))
+        shutil.copy2("test/yeet.flac", os.path.join(self.test_input_dir, "song3.flac"))
+        os.remove(os.path.join(self.test_input_dir, "song2.flac"))
+        main(self.test_input_dir, output_dir, no_processing=True, incremental=True)
+
+        self.assertEqual(os.stat(song1_copy).st_mtime_ns, 1)
+        self.assertTrue(os.path.exists(os.path.join(output_dir, "song3.flac")))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, "song2.flac")))
+
+    @patch("soundscrape.search_cover_art_by_text", fake_search_cover_art)
+    @patch("soundscrape.CoverArtSelector", FirstChoiceSelector)
+    def test_retag_while_copying_keeps_skipped_tracks(self):
+        """Test retag while copying: the skipped duplicate is still copied"""
+        albums_dir = self.make_albums()
+        output_dir = os.path.join(self.test_dir, "output")
+        main(albums_dir, output_dir, retag_while_copying=True)
+
+        self.assertEqual(len(audio_files_in(output_dir)), 3)
+        self.assertIn(os.path.join("B", "t2.mp3"), audio_files_in(output_dir))
+
+    @patch("soundscrape.search_cover_art_by_text", fake_search_cover_art)
+    @patch("soundscrape.CoverArtSelector", FirstChoiceSelector)
+    def test_atomic_rerun_leaves_files_alone(self):
+        """Test atomic mode: tracks already renamed and tagged aren't rewritten"""
+        albums_dir = self.make_albums()
+        process_dir(albums_dir, atomic=True)
+        modification_times = {}
+        for relative_path in audio_files_in(albums_dir):
+            path = os.path.join(albums_dir, relative_path)
+            modification_times[path] = os.stat(path).st_mtime_ns
+
+        process_dir(albums_dir, atomic=True)
+        for path, modification_time in modification_times.items():
+            self.assertEqual(os.stat(path).st_mtime_ns, modification_time)
+
+    @patch("soundscrape.search_cover_art_by_text", fake_search_cover_art)
+    @patch("soundscrape.CoverArtSelector", CountingSelector)
+    def test_only_next_selectors_are_built(self):
+        """Test that selectors are built a few albums ahead, not all at once"""
+        albums_dir = os.path.join(self.test_dir, "albums")
+        for i in range(8):
+            path = os.path.join(albums_dir, str(i), "t.mp3")
+            os.makedirs(os.path.dirname(path))
+            shutil.copy2("test/yeet.mp3", path)
+            set_album_title(path, f"Album {i}")
+        process_dir(albums_dir, skip_duplicates=False)
+
+        self.assertLessEqual(CountingSelector.most_alive, SELECTORS_AHEAD + 2)
+
+    @patch("soundscrape.ART_SEARCH_WORKERS", 1)
+    @patch("soundscrape.search_cover_art_by_text", search_waiting_on_first_selector)
+    @patch("soundscrape.CoverArtSelector", SignallingSelector)
+    def test_selector_is_not_queued_behind_searches(self):
+        """Test that the first selector is built while later albums are still searched"""
+        first_selector_built.clear()
+        b_search_saw_selector.clear()
+        albums_dir = self.make_albums()
+        process_dir(albums_dir, skip_duplicates=False)
+
+        self.assertEqual(b_search_saw_selector, [True])
+        self.assertEqual(len(audio_files_in(albums_dir)), 3)
+
+    @patch("soundscrape.CoverArtSelector", FirstChoiceSelector)
+    def test_art_searches_overlap(self):
+        """Test that the art for several albums is searched at the same time"""
+        albums_dir = os.path.join(self.test_dir, "albums")
+        for i in range(4):
+            path = os.path.join(albums_dir, str(i), "t.mp3")
+            os.makedirs(os.path.dirname(path))
+            shutil.copy2("test/yeet.mp3", path)
+            set_album_title(path, f"Album {i}")
+
+        search = OverlapCountingSearch()
+        with patch("soundscrape.search_cover_art_by_text", search):
+            process_dir(albums_dir, skip_duplicates=False)
+        self.assertGreater(search.most_running, 1)
+
+    def test_job_journal_ignores_half_written_line(self):
+        """Test that a line cut off by a crash is ignored"""
+        journal = JobJournal(self.test_dir)
+        journal.record("A", "art_chosen", digest="abc")
+        journal.record("A", "written", files={})
+        with open(os.path.join(self.test_dir, JOURNAL_FILENAME), "a") as f:
+            f.write('{"album": "B", "stage": "wri')
+
+        journal = JobJournal(self.test_dir)
+        self.assertEqual(journal.get("A", "art_chosen")["digest"], "abc")
+        self.assertIsNotNone(journal.get("A", "written"))
+        self.assertIsNone(journal.get("B", "written"))
+
+    @patch("soundscrape.CoverArtSelector", FirstChoiceSelector)
+    def test_resume_after_crash(self):
+        """Test that a run after a crash skips the finished album and finishes the rest"""
+        expected_files = [
+            os.path.join("A", "Song Two.flac"),
+            os.path.join("A", "Song Two.mp3"),
+            os.path.join("B", "Song Two.mp3"),
+        ]
+        for incremental in [False, True]:
+            albums_dir = self.make_albums()
+            output_dir = os.path.join(self.test_dir, "output")
+            with patch("soundscrape.search_cover_art_by_text", search_failing_on_b):
+                with self.assertRaises(RuntimeError):
+                    main(
+                        albums_dir,
+                        output_dir,
+                        skip_duplicates=False,
+                        incremental=incremental,
+                    )
+            self.assertTrue(os.path.exists(os.path.join(output_dir, JOURNAL_FILENAME)))
+            # Would be gone if the landing zone were cleared
+            marker_path = os.path.join(output_dir, "marker")
+            open(marker_path, "w").close()
+
+            output = StringIO()
+            with patch("soundscrape.search_cover_art_by_text", fake_search_cover_art):
+                with redirect_stdout(output):
+                    main(
+                        albums_dir,
+                        output_dir,
+                        skip_duplicates=False,
+                        incremental=incremental,
+                    )
+            self.assertIn("A was finished by an earlier run", output.getvalue())
+            self.assertEqual(audio_files_in(output_dir), expected_files)
+            self.assertTrue(os.path.exists(marker_path))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, JOURNAL_FILENAME)))
+            shutil.rmtree(albums_dir)
+            shutil.rmtree(output_dir)
+
+    @patch("soundscrape.search_cover_art_by_text", fake_search_cover_art)
+    @patch("soundscrape.CoverArtSelector", LastChoiceSelector)
+    def test_plan_and_apply_in_place(self):
+        """Test a dry run in place, then applying its plan"""
+        albums_dir = self.make_albums()
+        process_dir(albums_dir, dry_run=True)
+        self.assertIn(os.path.join("A", "t0.mp3"), audio_files_in(albums_dir))
+
+        with open(os.path.join(albums_dir, PLAN_FILENAME)) as f:
+            plan = json.load(f)
+        written_paths = apply_plan(plan)
+        self.assertEqual(len(written_paths), 2)
+        self.assertEqual(
+            audio_files_in(albums_dir),
+            [
+                os.path.join("A", "Song Two.flac"),
+                os.path.join("A", "Song Two.mp3"),
+                os.path.join("B", "t2.mp3"),
+            ],
+        )
+        expected_art = fake_search_cover_art("", "")
+        for new_path in written_paths.values():
+            self.assertEqual(get_cover_art(new_path), expected_art)
+
+    @patch("soundscrape.search_cover_art_by_text", fake_search_cover_art)
+    @patch("soundscrape.CoverArtSelector", LastChoiceSelector)
+    def test_plan_and_apply_copying(self):
+        """Test a dry run from the input, then applying its plan to the landing zone"""
+        albums_dir = self.make_albums()
+        output_dir = os.path.join(self.test_dir, "output")
+        os.makedirs(output_dir)
+        # Left by a run that crashed, which the dry run must not touch
+        journal_path = os.path.join(output_dir, JOURNAL_FILENAME)
+        with open(journal_path, "w") as f:
+            f.write('{"album": "C", "stage": "art_fetched", "digest": "abc"}\n')
+
+        main(albums_dir, output_dir, dry_run=True, shrink_art=True)
+        self.assertEqual(audio_files_in(output_dir), [])
+        self.assertTrue(os.path.exists(journal_path))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, INDEX_FILENAME)))
+
+        with open(os.path.join(output_dir, PLAN_FILENAME)) as f:
+            plan = json.load(f)
+        written_paths = apply_plan(plan)
+        self.assertEqual(
+            audio_files_in(output_dir),
+            [
+                os.path.join("A", "Song Two.flac"),
+                os.path.join("A", "Song Two.mp3"),
+                os.path.join("B", "t2.mp3"),
+            ],
+        )
+        expected_art = normalize_art(fake_search_cover_art("", ""))
+        for old_path, new_path in written_paths.items():
+            self.assertTrue(old_path.startswith(albums_dir))
+            self.assertEqual(get_cover_art(new_path), expected_art)
+
+    @patch("soundscrape.search_cover_art_by_text", search_agreeing_on_a)
+    @patch("soundscrape.CoverArtSelector", NoWindowSelector)
+    def test_auto_select(self):
+        """Test auto selection: art found by two sources is used, the rest is left for review"""
+        albums_dir = self.make_albums()
+        process_dir(albums_dir, skip_duplicates=False, auto_select=True)
+
+        self.assertEqual(
+            audio_files_in(albums_dir),
+            [
+                os.path.join("A", "Song Two.flac"),
+                os.path.join("A", "Song Two.mp3"),
+                os.path.join("B", "t2.mp3"),
+            ],
+        )
+        with open(os.path.join(albums_dir, REVIEW_FILENAME)) as f:
+            review = json.load(f)
+        self.assertEqual(
+            review,
+            [{"album": "B", "tracks": [os.path.join(albums_dir, "B", "t2.mp3")]}],
+        )
+
+    @patch("soundscrape.CoverArtSelector", FirstChoiceSelector)
+    def test_review_queue_in_landing_zone(self):
+        """Test that albums left for review can be finished from the landing zone"""
+        albums_dir = self.make_albums()
+        output_dir = os.path.join(self.test_dir, "output")
+        review_path = os.path.join(output_dir, REVIEW_FILENAME)
+        with patch("soundscrape.search_cover_art_by_text", search_agreeing_on_a):
+            main(
+                albums_dir,
+                output_dir,
+                retag_while_copying=True,
+                skip_duplicates=False,
+                auto_select=True,
+            )
+        with open(review_path) as f:
+            review = json.load(f)
+        self.assertEqual(review[0]["tracks"], [os.path.join(output_dir, "B", "t2.mp3")])
+        self.assertTrue(os.path.exists(review[0]["tracks"][0]))
+
+        with patch("soundscrape.search_cover_art_by_text", fake_search_cover_art):
+            process_dir(output_dir, skip_duplicates=False, skip_processed=True)
+        self.assertIn(os.path.join("B", "Song Two.mp3"), audio_files_in(output_dir))
+        self.assertFalse(os.path.exists(review_path))
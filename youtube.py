@@ -8,7 +8,7 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.wait import WebDriverWait
 
-from file_metadata import set_album_artist, set_album_title, set_artist, set_song_title
+from file_metadata import TagTransaction
 from stealth_driver import create_stealth_driver
 
 
@@ -199,10 +199,11 @@ def process_link(link: str, cover_art: bool = False, music: bool = False):
         metadata = get_yt_music_metadata(link)
 
         # Set metadata using our API
-        set_song_title(newly_downloaded_file, metadata.title)
-        set_artist(newly_downloaded_file, metadata.artists[0])
-        set_album_artist(newly_downloaded_file, metadata.artists[0])
-        set_album_title(newly_downloaded_file, metadata.album)
+        with TagTransaction(newly_downloaded_file) as transaction:
+            transaction.set("title", metadata.title)
+            transaction.set("artist", metadata.artists[0])
+            transaction.set("album_artist", metadata.artists[0])
+            transaction.set("album", metadata.album)
         # TODO: Add year support when metadata.year is available
 
         # Search from back to front for "." indicating file extension